@@ -1,10 +1,13 @@
-import matplotlib.pyplot as plt
+import datetime
 import io
+from zoneinfo import ZoneInfo
+from matplotlib.figure import Figure
 
-def create_chart(data: list, title: str) -> io.BytesIO:
+def create_chart(data: list, title: str) -> bytes:
     """
     Малює графік: data = [(user_id, count), ...]
-    Повертає байт-об'єкт картинки.
+    Повертає PNG у байтах.
+    Без pyplot: кожен виклик має власну Figure, тож нічого глобального між рендерами не лишається.
     """
     if not data:
         return None
@@ -13,26 +16,80 @@ def create_chart(data: list, title: str) -> io.BytesIO:
     users = [f"..{str(x[0])[-4:]}" for x in data] 
     counts = [x[1] for x in data]
 
-    plt.figure(figsize=(8, 5))
+    fig = Figure(figsize=(8, 5))
+    ax = fig.add_subplot()
     # Малюємо стовпчики
-    bars = plt.bar(users, counts, color='#6c5ce7') # Фіолетовий колір
+    bars = ax.bar(users, counts, color='#6c5ce7') # Фіолетовий колір
 
-    plt.xlabel('Користувачі (ID)')
-    plt.ylabel('Повідомлення')
-    plt.title(title)
-    plt.grid(axis='y', linestyle='--', alpha=0.5)
+    ax.set_xlabel('Користувачі (ID)')
+    ax.set_ylabel('Повідомлення')
+    ax.set_title(title)
+    ax.grid(axis='y', linestyle='--', alpha=0.5)
 
     # Цифри над стовпчиками
     for bar in bars:
         height = bar.get_height()
-        plt.text(bar.get_x() + bar.get_width()/2., height,
-                 f'{int(height)}',
-                 ha='center', va='bottom')
+        ax.text(bar.get_x() + bar.get_width()/2., height,
+                f'{int(height)}',
+                ha='center', va='bottom')
 
     # Зберігаємо в буфер пам'яті
     buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-    plt.close()
-    
-    return buf
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+def _local_hour(bucket: int, tz_name: str) -> datetime.datetime:
+    # bucket - години від epoch (UTC)
+    return datetime.datetime.fromtimestamp(bucket * 3600, ZoneInfo(tz_name))
+
+def create_activity_chart(buckets: list, title: str, tz_name: str = "UTC") -> bytes:
+    """
+    Активність чату по днях: buckets = [(bucket, grain, count), ...] з db.get_chat_activity.
+    Години і дні складаються в дні; місячні періоди малюються одним стовпчиком на початок місяця.
+    """
+    if not buckets:
+        return None
+
+    per_day = {}
+    for bucket, grain, count in buckets:
+        day = _local_hour(bucket, tz_name).date()
+        per_day[day] = per_day.get(day, 0) + count
+    days = sorted(per_day)
+
+    fig = Figure(figsize=(10, 5))
+    ax = fig.add_subplot()
+    ax.bar(days, [per_day[d] for d in days], color='#00b894')
+    ax.set_ylabel('Повідомлення')
+    ax.set_title(title)
+    ax.grid(axis='y', linestyle='--', alpha=0.5)
+    fig.autofmt_xdate()
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+def create_heatmap(buckets: list, title: str, tz_name: str = "UTC") -> bytes:
+    """
+    Теплова карта "день тижня x година": buckets = [(bucket, grain, count), ...].
+    Беруться лише погодинні періоди - у згорнутих днях година вже невідома.
+    """
+    grid = [[0] * 24 for _ in range(7)]
+    for bucket, grain, count in buckets:
+        if grain == 0:
+            moment = _local_hour(bucket, tz_name)
+            grid[moment.weekday()][moment.hour] += count
+    if not any(map(any, grid)):
+        return None
+
+    fig = Figure(figsize=(10, 4))
+    ax = fig.add_subplot()
+    image = ax.imshow(grid, aspect='auto', cmap='Purples')
+    ax.set_yticks(range(7), ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Нд'])
+    ax.set_xticks(range(0, 24, 2))
+    ax.set_xlabel('Година')
+    ax.set_title(title)
+    fig.colorbar(image, ax=ax, label='Повідомлення')
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
@@ -0,0 +1,140 @@
+# chart_renderer.py
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import metrics
+
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", 1))
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", 200)) # Скільки готових PNG тримати
+
+
+def _draw(chart: str, *args):
+    # Виконується в процесі пулу: analytics (і matplotlib) імпортуються лише там, не в боті
+    import analytics
+    return getattr(analytics, chart)(*args)
+
+
+def _load():
+    import analytics
+
+
+class ChartRenderer:
+    """
+    Рендер графіків в окремих процесах: matplotlib тримає GIL майже весь рендер,
+    тож у потоці він гальмував би модерацію. Готові PNG кешуються за (chat_id, відбиток даних) -
+    поки дані ті самі, повторний /stats не малює нічого.
+    """
+
+    def __init__(self, workers: int = CHART_WORKERS, cache_size: int = CHART_CACHE_SIZE):
+        self.workers = workers
+        self.cache_size = cache_size
+        self._pool = None
+        self._cache = OrderedDict()  # {(chat_id, fingerprint): png bytes}
+        self._inflight = {}          # {(chat_id, fingerprint): Future} - однакові запити малюються один раз
+        self.hits = 0
+        self.misses = 0
+        self.render_seconds_total = 0.0
+        self.last_render_seconds = 0.0
+        self.warm_up_seconds = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            # forkserver: воркери не успадковують з'єднань, потоків і стану бота,
+            # а matplotlib імпортується один раз у сервері. main.py воркер лише імпортує
+            # (запуск бота захищений if __name__ == "__main__")
+            ctx = multiprocessing.get_context("forkserver")
+            ctx.set_forkserver_preload(["analytics"])
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+        return self._pool
+
+    def _drop_pool(self, pool):
+        # Воркер впав (OOM, segfault у matplotlib): зламаний пул більше нічого не прийме,
+        # тож закриваємо його, а наступний рендер підніме новий
+        if self._pool is pool:
+            self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def fingerprint(fn_name: str, *args) -> str:
+        return hashlib.blake2b(repr((fn_name, args)).encode(), digest_size=16).hexdigest()
+
+    async def render(self, chat_id: int, chart: str, *args) -> bytes:
+        """Викликає analytics.<chart>(*args) у пулі процесів або бере PNG з кешу."""
+        key = (chat_id, self.fingerprint(chart, *args))
+        png = self._cache.get(key)
+        if png is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return png
+
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.hits += 1
+            try:
+                return await asyncio.shield(fut)
+            except BrokenProcessPool:
+                return None
+
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        pool = self._get_pool()
+        start = time.perf_counter()
+        try:
+            fut = loop.run_in_executor(pool, _draw, chart, *args)
+            self._inflight[key] = fut
+            png = await asyncio.shield(fut)
+        except BrokenProcessPool as e:
+            print(f"Пул рендеру графіків зламався, перезапускаємо: {e}")
+            self._drop_pool(pool)
+            return None
+        finally:
+            self._inflight.pop(key, None)
+
+        elapsed = time.perf_counter() - start
+        self.last_render_seconds = elapsed
+        self.render_seconds_total += elapsed
+        if metrics.ENABLED:
+            metrics.CHART_SECONDS.observe(elapsed, chart)
+
+        if png is not None:
+            self._cache[key] = png
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return png
+
+    async def warm_up(self):
+        """Піднімає пул і імпортує matplotlib заздалегідь, щоб перший /stats не чекав."""
+        start = time.perf_counter()
+        pool = self._get_pool()
+        try:
+            await asyncio.get_running_loop().run_in_executor(pool, _load)
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                self._drop_pool(pool)
+            print(f"Не вдалося прогріти рендер графіків: {e}")
+            return
+        self.warm_up_seconds = time.perf_counter() - start
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "chart_cache_hits_total": self.hits,
+            "chart_cache_misses_total": self.misses,
+            "chart_cache_hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "chart_cache_size": len(self._cache),
+            "chart_last_render_seconds": round(self.last_render_seconds, 3),
+            "chart_avg_render_seconds": round(self.render_seconds_total / self.misses, 3) if self.misses else 0.0,
+        }
+
+
+renderer = ChartRenderer()
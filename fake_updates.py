@@ -0,0 +1,60 @@
+# fake_updates.py
+# Шле бота фейкові апдейти на вебхук - щоб перевірити прийом і черги без Telegram.
+# Запуск: UPDATES_MODE=webhook WEBHOOK_SECRET=... python main.py
+#         python fake_updates.py --count 1000 --chats 50
+# Виклики API у відповідь на фейкові чати Telegram відхилить - бот лише надрукує помилки.
+import argparse
+import asyncio
+import os
+import random
+import time
+import aiohttp
+
+TEXTS = ["привіт", "як справи?", "хто йде на каву", "👍", "дякую!"]
+
+
+def make_update(update_id: int, chat_id: int, user_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Test chat {chat_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": random.choice(TEXTS),
+        },
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram updates poster")
+    parser.add_argument("--url", default=f"http://localhost:{os.getenv('PORT', 8000)}{os.getenv('WEBHOOK_PATH', '/webhook')}")
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""))
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    statuses = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret}
+
+    async def post(session, update_id):
+        chat_id = -1000000000000 - random.randint(1, args.chats)
+        update = make_update(update_id, chat_id, random.randint(1, 1000))
+        async with semaphore:
+            try:
+                async with session.post(args.url, json=update, headers=headers) as resp:
+                    statuses[resp.status] = statuses.get(resp.status, 0) + 1
+            except aiohttp.ClientError as e:
+                statuses[type(e).__name__] = statuses.get(type(e).__name__, 0) + 1
+
+    start = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(post(session, n) for n in range(1, args.count + 1)))
+    elapsed = time.monotonic() - start
+    print(f"Sent {args.count} updates in {elapsed:.2f}s ({args.count / elapsed:.0f}/s): {statuses}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+# flood_control.py
+import time
+from array import array
+
+
+class _Window:
+    """
+    Кільцевий буфер з часом останніх limit повідомлень одного юзера в одному чаті.
+    Флуд - це коли нове повідомлення прийшло швидше, ніж за window секунд від найстарішого з них
+    (тобто у вікні виявилось більше ніж limit повідомлень).
+    """
+    __slots__ = ("times", "pos", "last")
+
+    def __init__(self, size: int):
+        self.times = array("d", [float("-inf")]) * size
+        self.pos = 0
+        self.last = 0.0
+
+
+class FloodDetector:
+    """
+    Анти-флуд з O(1) на повідомлення.
+    Ключ - (chat_id, user_id), тож активність у різних чатах не змішується.
+    Неактивні записи періодично вичищаються, щоб пам'ять не росла вічно.
+    """
+
+    def __init__(self, limit: int = 5, window: float = 10, sweep_interval: float = 60):
+        self.default_limits = (limit, window)
+        self.chat_limits = {}  # {chat_id: (limit, window)} - налаштування з settings
+        self.sweep_interval = sweep_interval
+        self._windows = {}
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def __len__(self):
+        return len(self._windows)
+
+    def set_limits(self, chat_id: int, limit: int, window: float):
+        self.chat_limits[chat_id] = (limit, window)
+
+    def get_limits(self, chat_id: int) -> tuple[int, float]:
+        return self.chat_limits.get(chat_id, self.default_limits)
+
+    def hit(self, chat_id: int, user_id: int, now: float = None) -> bool:
+        """Рахує повідомлення. Повертає True, якщо юзер перевищив ліміт."""
+        if now is None:
+            now = time.monotonic()
+        if now >= self._next_sweep:
+            self.sweep(now)
+
+        limit, window = self.chat_limits.get(chat_id, self.default_limits)
+        key = (chat_id, user_id)
+        w = self._windows.get(key)
+        if w is None or len(w.times) != limit:
+            # Новий юзер або адмін змінив ліміт - починаємо з чистого буфера
+            w = self._windows[key] = _Window(limit)
+
+        oldest = w.times[w.pos]
+        w.times[w.pos] = now
+        w.pos = (w.pos + 1) % len(w.times)
+        w.last = now
+        return now - oldest < window
+
+    def reset(self, chat_id: int, user_id: int):
+        # Після покарання забуваємо історію, щоб не карати вдруге за ті самі повідомлення
+        self._windows.pop((chat_id, user_id), None)
+
+    def sweep(self, now: float = None):
+        """Видаляє тих, хто не писав довше, ніж вікно їхнього чату."""
+        if now is None:
+            now = time.monotonic()
+        limits, default = self.chat_limits, self.default_limits
+        stale = [key for key, w in self._windows.items()
+                 if now - w.last >= limits.get(key[0], default)[1]]
+        for key in stale:
+            del self._windows[key]
+        self._next_sweep = now + self.sweep_interval
@@ -1,67 +1,302 @@
 # image_checker.py
 import asyncio
-from sightengine.client import SightengineClient
+import io
 import os
+import time
+from collections import OrderedDict
+import aiohttp
+import database as db
+import media_queue
+
 # Беремо ключі з сервера
 API_USER = os.getenv("SIGHTENGINE_USER")
 API_SECRET = os.getenv("SIGHTENGINE_SECRET")
+# Адресу можна підмінити на локальний фейковий сервер (для тестів)
+API_URL = os.getenv("SIGHTENGINE_URL", "https://api.sightengine.com/1.0/check.json")
+API_TIMEOUT = float(os.getenv("SIGHTENGINE_TIMEOUT", 10))     # секунд на один запит
+API_CONCURRENCY = int(os.getenv("SIGHTENGINE_CONCURRENCY", 8)) # скільки запитів одночасно
 
-API_USER = os.getenv("SIGHTENGINE_USER")
-API_SECRET = os.getenv("SIGHTENGINE_SECRET")
+
+class ModerationClient:
+    """
+    Асинхронний клієнт Sightengine на aiohttp.
+    Одна сесія з пулом з'єднань на весь час роботи бота, таймаут на кожен запит
+    і ліміт одночасних запитів (замість потоків з run_in_executor).
+    """
+
+    def __init__(self, api_user: str, api_secret: str, url: str = API_URL,
+                 timeout: float = API_TIMEOUT, concurrency: int = API_CONCURRENCY):
+        self.api_user = api_user
+        self.api_secret = api_secret
+        self.url = url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Сесію створюємо ліниво - вона має жити всередині запущеного event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def check(self, image_bytes: bytes, models: str = "nudity,wad,offensive,gore") -> dict:
+        form = aiohttp.FormData()
+        form.add_field("models", models)
+        form.add_field("api_user", self.api_user)
+        form.add_field("api_secret", self.api_secret)
+        form.add_field("media", image_bytes, filename="image.jpg", content_type="image/jpeg")
+
+        async with self._semaphore:
+            async with self._get_session().post(self.url, data=form) as resp:
+                output = await resp.json(content_type=None)
+
+        if resp.status != 200 or output.get('status') == 'failure':
+            raise RuntimeError(output.get('error', {}).get('message', f"Sightengine HTTP {resp.status}"))
+        return output
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+
+# Якщо API масово падає чи тупить - перестаємо його смикати на BREAKER_COOLDOWN секунд
+breaker = media_queue.CircuitBreaker(
+    failure_ratio=float(os.getenv("BREAKER_FAILURE_RATIO", 0.5)),
+    cooldown=float(os.getenv("BREAKER_COOLDOWN", 60)),
+)
 
 client = None
 if API_USER and API_SECRET:
-    client = SightengineClient(API_USER, API_SECRET)
+    client = ModerationClient(API_USER, API_SECRET)
 else:
     print("⚠️ WARNING: Sightengine keys are missing. Image checks will be skipped.")
 
-async def check_image_content(file_path: str) -> str | None:
-    if not client: 
-        return None # Просто пропускаємо, якщо немає ключів
+async def close():
+    # Викликається при зупинці бота
+    if client:
+        await client.close()
 
+# --- КЕШ ВЕРДИКТІВ ---
+# Одні й ті самі спам-картинки шлють знову і знову: пам'ятаємо вердикт
+# за file_unique_id, а для перезбережених копій - за perceptual hash (dHash).
+VERDICT_CACHE_SIZE = int(os.getenv("VERDICT_CACHE_SIZE", 50000))
+VERDICT_TTL_OK_DAYS = int(os.getenv("VERDICT_TTL_OK_DAYS", 7))
+VERDICT_TTL_BAD_DAYS = int(os.getenv("VERDICT_TTL_BAD_DAYS", 30))
+HASH_DISTANCE = int(os.getenv("HASH_DISTANCE", 6)) # Скільки бітів з 64 можуть відрізнятись у "тієї ж" картинки
 
-async def check_image_content(file_path: str) -> str | None:
+# {media_key: (verdict, до якого часу)}; verdict = 'heavy' або None (чиста картинка)
+_verdicts = OrderedDict()
+HASH_MASK = 0xFFFFFFFFFFFFFFFF
+HASH_PRUNE_INTERVAL = 3600 # секунд між прибираннями протухлих поганих хешів
+
+
+class _HashIndex:
     """
-    Відправляє фото на перевірку в AI.
+    Погані хеші з індексом для пошуку схожих (не більше distance різних бітів).
+    64 біти ділимо на distance + 1 смуг: у схожого хеша хоча б одна смуга збігається точно,
+    тож перевіряємо лише хеші з тими самими смугами, а не весь список.
+    Записи мають строк (як у media_verdicts) і раз на HASH_PRUNE_INTERVAL прибираються.
+    """
+
+    def __init__(self, distance: int):
+        self.distance = distance
+        bands = distance + 1
+        self._bands = [(64 * i // bands, 64 * (i + 1) // bands) for i in range(bands)]
+        self._buckets = [{} for _ in self._bands] # По смузі: {значення смуги: set хешів}
+        self._expires = {} # {hash: до якого часу (unix time)}
+        self._next_prune = 0.0
+
+    def __len__(self):
+        return len(self._expires)
+
+    def _keys(self, phash: int):
+        value = phash & HASH_MASK
+        return [(value >> start) & ((1 << (end - start)) - 1) for start, end in self._bands]
+
+    def add(self, phash: int, expires_at: float):
+        self._maybe_prune()
+        if phash in self._expires:
+            self._expires[phash] = max(self._expires[phash], expires_at)
+            return
+        self._expires[phash] = expires_at
+        for bucket, key in zip(self._buckets, self._keys(phash)):
+            bucket.setdefault(key, set()).add(phash)
+
+    def discard(self, phash: int):
+        if self._expires.pop(phash, None) is None:
+            return
+        for bucket, key in zip(self._buckets, self._keys(phash)):
+            same = bucket[key]
+            same.discard(phash)
+            if not same:
+                del bucket[key]
+
+    def find(self, phash: int) -> bool:
+        """Чи є живий поганий хеш, схожий на цей."""
+        now = self._maybe_prune()
+        for bucket, key in zip(self._buckets, self._keys(phash)):
+            for bad in bucket.get(key, ()):
+                if ((phash ^ bad) & HASH_MASK).bit_count() <= self.distance and self._expires[bad] > now:
+                    return True
+        return False
+
+    def _maybe_prune(self) -> float:
+        now = time.time()
+        if now >= self._next_prune:
+            self._next_prune = now + HASH_PRUNE_INTERVAL
+            for phash in [h for h, expires_at in self._expires.items() if expires_at <= now]:
+                self.discard(phash)
+        return now
+
+
+# Хеші відомих поганих картинок (для пошуку схожих, а не лише однакових)
+BAD_HASHES = _HashIndex(HASH_DISTANCE)
+
+def dhash(image_bytes: bytes) -> int:
+    """64-бітний difference hash: стійкий до перестиснення і зміни розміру."""
+    from PIL import Image # Pillow потрібен лише для медіа - не вантажимо його на старті
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img.draft("L", (64, 64)) # Для JPEG декодуємо одразу в зменшеному розмірі - в рази швидше
+        pixels = list(img.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            value = (value << 1) | (left > pixels[row * 9 + col + 1])
+    # У Postgres BIGINT знаковий, тому зберігаємо як signed
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def _remember(key: str, verdict: str | None, ttl_days: int):
+    loop_time = asyncio.get_running_loop().time()
+    _verdicts[key] = (verdict, loop_time + ttl_days * 86400)
+    _verdicts.move_to_end(key)
+    while len(_verdicts) > VERDICT_CACHE_SIZE:
+        _verdicts.popitem(last=False)
+
+async def _lookup(key: str):
+    """Повертає (знайдено, вердикт). Спершу пам'ять, потім БД."""
+    entry = _verdicts.get(key)
+    if entry:
+        if entry[1] > asyncio.get_running_loop().time():
+            _verdicts.move_to_end(key)
+            return True, entry[0]
+        del _verdicts[key]
+
+    try:
+        stored = await db.get_media_verdict(key)
+    except Exception as e:
+        print(f"Помилка читання кешу картинок: {e}")
+        return False, None
+    if stored is None:
+        return False, None
+    verdict = "heavy" if stored == "heavy" else None
+    # У пам'ять кладемо ненадовго: точний строк знає БД
+    _remember(key, verdict, 1)
+    return True, verdict
+
+async def load_bad_hashes():
+    """Викликається при старті: підтягуємо відомі погані хеші з БД."""
+    now = time.time()
+    for row in await db.get_bad_media_hashes():
+        BAD_HASHES.add(row['phash'], now + row['ttl'])
+
+async def get_cached_verdict(file_unique_id: str):
+    """Перевірка ДО завантаження файлу. Повертає (знайдено, вердикт)."""
+    return await _lookup(f"u:{file_unique_id}")
+
+async def get_hash_verdict(phash: int):
+    """Перевірка по хешу вже завантаженої картинки. Повертає (знайдено, вердикт)."""
+    found, verdict = await _lookup(f"h:{phash}")
+    if found:
+        return found, verdict
+    # Схожа на відому погану картинку - блокуємо без запиту до API
+    if BAD_HASHES.find(phash):
+        return True, "heavy"
+    return False, None
+
+async def save_verdict(file_unique_id: str | None, phash: int | None, verdict: str | None):
+    keys = []
+    if file_unique_id: keys.append(f"u:{file_unique_id}")
+    if phash is not None: keys.append(f"h:{phash}")
+    ttl = VERDICT_TTL_BAD_DAYS if verdict else VERDICT_TTL_OK_DAYS
+    for key in keys:
+        _remember(key, verdict, ttl)
+    if verdict and phash is not None:
+        BAD_HASHES.add(phash, time.time() + ttl * 86400)
+    try:
+        await db.save_media_verdicts(keys, verdict or "ok", phash, ttl)
+    except Exception as e:
+        print(f"Помилка запису кешу картинок: {e}")
+
+async def check_image_content(image_bytes: bytes, file_unique_id: str = None) -> str | None:
+    """
+    Перевіряє фото: спершу кеш вердиктів (file_unique_id, потім хеш), і лише потім AI.
     Повертає 'heavy' (оголення, зброя, насильство) або None.
     """
+    phash = None
     try:
-        # Оскільки бібліотека синхронна, запускаємо її в окремому потоці,
-        # щоб не блокувати бота
-        loop = asyncio.get_running_loop()
-        
-        # Перевіряємо на оголення (nudity), зброю (wad), образи (offensive) і gore (кров/насильство)
-        output = await loop.run_in_executor(None, lambda: client.check('nudity', 'wad', 'offensive', 'gore').set_file(file_path))
-
-        # 1. Оголення (Nudity) - ЗБАЛАНСОВАНИЙ СУВОРИЙ РЕЖИМ
-        nudity = output.get('nudity', {})
-        
-        # 1. Повне оголення (Raw)
-        # Ставимо 5% - це дуже мало, але відсіє порнографію моментально
-        if nudity.get('raw', 0) > 0.05:
-            return "heavy"
-
-        # 2. Часткове оголення (Partial)
-        if nudity.get('partial', 0) > 0.15: 
-             return "heavy"
-     
-        # 3. Безпечне (Safe)
-        if nudity.get('safe', 1) < 0.90:
-            return "heavy"
-        
-        # 2. Зброя/Алкоголь/Наркотики (WAD)
-        wad = output.get('weapon', 0)
-        if wad > 0.8: # Якщо ймовірність зброї більше 80%
-            return "heavy"
-
-        # 3. Кров/Насильство (Gore)
-        gore = output.get('gore', {}).get('prob', 0)
-        if gore > 0.8:
-            return "heavy"
+        phash = dhash(image_bytes)
+        found, verdict = await get_hash_verdict(phash)
+        if found:
+            if file_unique_id:
+                await save_verdict(file_unique_id, None, verdict)
+            return verdict
+    except Exception as e:
+        print(f"Не вдалося порахувати хеш картинки: {e}")
 
+    if not client:
+        return None # Просто пропускаємо, якщо немає ключів
 
-        return None
+    if not breaker.allow():
+        return None # API зараз недоступне - пропускаємо перевірку, а не чекаємо таймауту
 
+    try:
+        verdict = await _check_with_api(image_bytes)
     except Exception as e:
+        # Помилку API не кешуємо - наступного разу спробуємо ще
+        breaker.record(False)
         print(f"Помилка перевірки зображення: {e}")
         return None
+    breaker.record(True)
+
+    await save_verdict(file_unique_id, phash, verdict)
+    return verdict
+
+async def _check_with_api(image_bytes: bytes) -> str | None:
+    """
+    Відправляє фото на перевірку в AI.
+    Повертає 'heavy' (оголення, зброя, насильство) або None.
+    """
+    # Перевіряємо на оголення (nudity), зброю (wad), образи (offensive) і gore (кров/насильство)
+    output = await client.check(image_bytes, "nudity,wad,offensive,gore")
+
+    # 1. Оголення (Nudity) - ЗБАЛАНСОВАНИЙ СУВОРИЙ РЕЖИМ
+    nudity = output.get('nudity', {})
+
+    # 1. Повне оголення (Raw)
+    # Ставимо 5% - це дуже мало, але відсіє порнографію моментально
+    if nudity.get('raw', 0) > 0.05:
+        return "heavy"
+
+    # 2. Часткове оголення (Partial)
+    if nudity.get('partial', 0) > 0.15:
+         return "heavy"
+
+    # 3. Безпечне (Safe)
+    if nudity.get('safe', 1) < 0.90:
+        return "heavy"
+
+    # 2. Зброя/Алкоголь/Наркотики (WAD)
+    wad = output.get('weapon', 0)
+    if wad > 0.8: # Якщо ймовірність зброї більше 80%
+        return "heavy"
+
+    # 3. Кров/Насильство (Gore)
+    gore = output.get('gore', {}).get('prob', 0)
+    if gore > 0.8:
+        return "heavy"
+
+
+    return None
@@ -0,0 +1,165 @@
+# log_digest.py
+import asyncio
+import html
+import os
+import re
+from aiogram.types import BufferedInputFile, InputMediaPhoto
+import outbound
+
+# Під час рейду сотні логів на одного адміна з'їдають ліміт відправки,
+# тому звичайні події збираємо і шлемо дайджестом.
+DIGEST_INTERVAL = float(os.getenv("LOG_DIGEST_INTERVAL", 10)) # секунд
+DIGEST_MAX_EVENTS = int(os.getenv("LOG_DIGEST_MAX", 30))      # або стільки подій - що раніше
+MESSAGE_LIMIT = 4096 # Ліміт довжини повідомлення Telegram
+CAPTION_LIMIT = 1024
+ALBUM_SIZE = 10      # Максимум фото в send_media_group
+# Скільки байтів фото може чекати в буфері одного адміна; понад це подія йде без фото
+PHOTO_BUFFER_BYTES = int(os.getenv("LOG_PHOTO_BUFFER_MB", 20)) * 1024 * 1024
+_TAG = re.compile(r"<[^>]+>")
+
+
+def _fit(text: str, limit: int) -> str:
+    """Текст у межах ліміту. Довгий - без розмітки (обрізання посеред тегу ламає HTML)."""
+    if len(text) <= limit:
+        return text
+    plain = html.unescape(_TAG.sub("", text))
+    return html.escape(plain[:limit - 1]) + "…"
+
+
+class LogAggregator:
+    def __init__(self, bot, interval: float = DIGEST_INTERVAL, max_events: int = DIGEST_MAX_EVENTS):
+        self.bot = bot
+        self.interval = interval
+        self.max_events = max_events
+        self._buffers = {} # {receiver_id: [(text, photo bytes або None), ...]}
+        self._timers = {}  # {receiver_id: asyncio.TimerHandle}
+        self._photo_bytes = {} # {receiver_id: скільки байтів фото в буфері}
+        self._tasks = set()
+        self.events_total = 0
+        self.messages_sent_total = 0
+        self.send_errors_total = 0
+        self.photos_dropped_total = 0
+
+    async def add(self, receiver_id: int, text: str, photo: bytes = None, critical: bool = False):
+        self.events_total += 1
+        if critical:
+            # Важливе (бан, скарга) - одразу, без дайджесту і з вищим пріоритетом,
+            # але у фоні: ліміт ЛС адміна не повинен тримати обробник повідомлення
+            self._spawn(self._send_single(receiver_id, text, photo, outbound.PRIORITY_NORMAL))
+            return
+
+        if photo:
+            held = self._photo_bytes.get(receiver_id, 0)
+            if held + len(photo) > PHOTO_BUFFER_BYTES:
+                photo = None # Пам'ять важливіша за картинку в дайджесті
+                self.photos_dropped_total += 1
+            else:
+                self._photo_bytes[receiver_id] = held + len(photo)
+
+        buffer = self._buffers.setdefault(receiver_id, [])
+        buffer.append((text, photo))
+        if len(buffer) >= self.max_events:
+            # Відправка може чекати на ліміти - не тримаємо обробник повідомлення
+            self._flush_later(receiver_id)
+        elif receiver_id not in self._timers:
+            loop = asyncio.get_running_loop()
+            self._timers[receiver_id] = loop.call_later(self.interval, self._flush_later, receiver_id)
+
+    def _flush_later(self, receiver_id: int):
+        self._spawn(self.flush(receiver_id))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self, receiver_id: int):
+        timer = self._timers.pop(receiver_id, None)
+        if timer:
+            timer.cancel()
+        self._photo_bytes.pop(receiver_id, None)
+        events = self._buffers.pop(receiver_id, None)
+        if not events:
+            return
+
+        if len(events) == 1:
+            await self._send_single(receiver_id, *events[0])
+            return
+
+        # Кожна відправка окремо: одна невдала не забирає з собою решту подій
+        with outbound.with_priority(outbound.PRIORITY_LOW):
+            # 1. Текстові події - одним дайджестом, порізаним під ліміт Telegram
+            texts = [text for text, photo in events if not photo]
+            if texts:
+                chunk = f"📦 <b>Дайджест модерації ({len(events)})</b>"
+                for text in texts:
+                    part = "\n\n" + _fit(text, MESSAGE_LIMIT - 100)
+                    if len(chunk) + len(part) > MESSAGE_LIMIT:
+                        await self._try(self._send_text(receiver_id, chunk), receiver_id)
+                        chunk = part.lstrip()
+                    else:
+                        chunk += part
+                await self._try(self._send_text(receiver_id, chunk), receiver_id)
+
+            # 2. Події з фото - альбомами по 10 замість окремого повідомлення на кожне
+            photos = [(text, photo) for text, photo in events if photo]
+            for i in range(0, len(photos), ALBUM_SIZE):
+                album = photos[i:i + ALBUM_SIZE]
+                if len(album) == 1:
+                    text, photo = album[0]
+                    await self._try(self._send_photo(receiver_id, text, photo), receiver_id)
+                else:
+                    await self._try(self._send_album(receiver_id, album), receiver_id)
+
+    async def _try(self, coro, receiver_id: int):
+        try:
+            await coro
+        except Exception as e:
+            self.send_errors_total += 1
+            print(f"Не вдалося відправити дайджест логів адміну {receiver_id}: {e}")
+
+    async def _send_photo(self, receiver_id: int, text: str, photo: bytes):
+        await self.bot.send_photo(chat_id=receiver_id, photo=BufferedInputFile(photo, filename="violation.jpg"),
+                                  caption=_fit(text, CAPTION_LIMIT), parse_mode="HTML")
+        self.messages_sent_total += 1
+
+    async def _send_album(self, receiver_id: int, album: list):
+        await self.bot.send_media_group(receiver_id, media=[
+            InputMediaPhoto(media=BufferedInputFile(photo, filename=f"violation{n}.jpg"),
+                            caption=_fit(text, CAPTION_LIMIT), parse_mode="HTML")
+            for n, (text, photo) in enumerate(album)
+        ])
+        self.messages_sent_total += 1
+
+    async def flush_all(self):
+        # При зупинці бота дописуємо все, що накопичилось, і чекаємо відправок, що вже йдуть
+        for receiver_id in list(self._buffers):
+            await self.flush(receiver_id)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _send_text(self, receiver_id: int, text: str):
+        await self.bot.send_message(chat_id=receiver_id, text=_fit(text, MESSAGE_LIMIT), parse_mode="HTML")
+        self.messages_sent_total += 1
+
+    async def _send_single(self, receiver_id: int, text: str, photo: bytes = None,
+                           priority: int = outbound.PRIORITY_LOW):
+        try:
+            with outbound.with_priority(priority):
+                if photo:
+                    await self._send_photo(receiver_id, text, photo)
+                else:
+                    await self._send_text(receiver_id, text)
+        except Exception as e:
+            self.send_errors_total += 1
+            print(f"Не вдалося відправити лог адміну {receiver_id}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "log_events_total": self.events_total,
+            "log_messages_sent_total": self.messages_sent_total,
+            "log_buffered": sum(len(b) for b in self._buffers.values()),
+            "log_buffered_photo_bytes": sum(self._photo_bytes.values()),
+            "log_send_errors_total": self.send_errors_total,
+            "log_photos_dropped_total": self.photos_dropped_total,
+        }
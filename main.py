@@ -1,22 +1,38 @@
+import time
+_PROCESS_START = time.monotonic() # Від цього моменту рахуємо час старту (див. startup_mark)
 import asyncio
 import logging
 import os
 import re
 import datetime
+import hashlib
+import hmac
+import html
+import json
 import sys
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.types import (
     Message, ChatPermissions, CallbackQuery, InlineKeyboardMarkup, 
-    InlineKeyboardButton, FSInputFile, ContentType
+    InlineKeyboardButton, ContentType, ChatMemberUpdated
 )
 from aiogram.filters import Command, CommandStart, BaseFilter
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
 from aiohttp import web  # Додали для фейкового сервера
-from aiogram.types import LabeledPrice, PreCheckoutQuery, BufferedInputFile
-import analytics
+from aiogram.types import LabeledPrice, PreCheckoutQuery, BufferedInputFile, Update
+import chart_renderer
 
 import database as db
 import word_list
+import flood_control
+import media_queue
+import outbound
+import log_digest
+import raid_guard
+import timers
+import update_shards
+import metrics
 import image_checker 
 
 # --- ЗМІНИ ТУТ ---
@@ -24,12 +40,16 @@ import image_checker
 TOKEN = os.getenv("BOT_TOKEN")
 
 bot = Bot(token=TOKEN)
+# Усі виклики API йдуть через планувальник: ліміти Telegram, пріоритети, retry_after
+outbound.setup(bot)
 dp = Dispatcher(storage=MemoryStorage())
 router = Router()
 dp.include_router(router)
-
-if not os.path.exists("temp_photos"):
-    os.makedirs("temp_photos")
+# Час виконання кожного хендлера для /metrics
+metrics.setup_router(router)
+# Апдейти розкладаються по воркерах за chat_id: порядок у чаті зберігається, чати - паралельно
+update_dispatch = update_shards.ShardedDispatch()
+dp.update.outer_middleware(update_dispatch)
 
 # ... (ВЕСЬ ТВІЙ КОД ФІЛЬТРІВ, ЛОГІВ, АДМІНКИ ЗАЛИШАЄТЬСЯ БЕЗ ЗМІН) ...
 # ... (від LINK_REGEX до global_listener включно) ...
@@ -40,9 +60,69 @@ if not os.path.exists("temp_photos"):
 async def health_check(request):
     return web.Response(text="Bot is running OK!")
 
+def collect_stats() -> dict:
+    # Стан черг, запобіжника AI, лімітів Telegram і кешів - для /status і /metrics
+    return {**media_checks.stats(), **image_checker.breaker.stats(),
+            **outbound.scheduler.stats(), **log_aggregator.stats(),
+            **update_dispatch.stats(), **webhook_stats, **chart_renderer.renderer.stats(),
+            **{f"startup_{stage}_seconds": sec for stage, sec in STARTUP_TIMES.items()},
+            "flood_cache_size": len(flood_detector),
+            "timers_pending": len(timer_scheduler),
+            "timers_fired_total": timer_scheduler.fired_total}
+
+async def status_check(request):
+    return web.Response(text=json.dumps({**collect_stats(), "shards": update_dispatch.shard_stats()}),
+                        content_type="application/json")
+
+async def metrics_handler(request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+# --- WEBHOOK ---
+# UPDATES_MODE=webhook: Telegram сам шле апдейти на цей сервер (без затримки polling,
+# і кілька копій бота можуть стояти за балансувальником). За замовчуванням - polling.
+WEBHOOK_MODE = os.getenv("UPDATES_MODE", "polling").lower() == "webhook"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/") # Публічна адреса, напр. https://bot.koyeb.app
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")        # Однаковий для всіх копій бота
+WEBHOOK_ACK_TIMEOUT = float(os.getenv("WEBHOOK_ACK_TIMEOUT", 2)) # секунд чекати місця в черзі
+webhook_stats = {"webhook_updates_total": 0, "webhook_rejected_total": 0, "webhook_busy_total": 0}
+# Webhook не чекає місця в переповненому шарді: відповідаємо 503, і Telegram пришле апдейт повторно
+update_dispatch.block = not WEBHOOK_MODE
+
+async def webhook_handler(request):
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        webhook_stats["webhook_rejected_total"] += 1
+        return web.Response(status=401)
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except Exception as e:
+        print(f"Bad webhook update: {e}")
+        return web.Response(status=400)
+
+    try:
+        # Апдейт лише кладеться в чергу шарда - обробка йде у воркерах, відповідаємо одразу.
+        # Шард переповнений (SHARD_FULL) або прийом завис довше ACK_TIMEOUT - 503, і Telegram пришле апдейт повторно
+        result = await asyncio.wait_for(dp.feed_update(bot, update), WEBHOOK_ACK_TIMEOUT)
+    except asyncio.TimeoutError:
+        result = update_shards.SHARD_FULL
+    if result is update_shards.SHARD_FULL:
+        webhook_stats["webhook_busy_total"] += 1
+        return web.Response(status=503)
+    webhook_stats["webhook_updates_total"] += 1
+    return web.Response()
+
+metrics.register_gauges(collect_stats)
+metrics.register_labelled_gauges(update_dispatch.labelled_gauges)
+
 async def start_web_server():
     app = web.Application()
     app.router.add_get('/', health_check)
+    app.router.add_get('/status', status_check)
+    if metrics.ENABLED:
+        app.router.add_get('/metrics', metrics_handler)
+    if WEBHOOK_MODE:
+        app.router.add_post(WEBHOOK_PATH, webhook_handler)
     runner = web.AppRunner(app)
     await runner.setup()
     # Koyeb дає порт через змінну PORT, або використовуємо 8000
@@ -51,21 +131,104 @@ async def start_web_server():
     await site.start()
     print(f"Web server started on port {port}")
 
-if not os.path.exists("temp_photos"):
-    os.makedirs("temp_photos")
-
 # Регулярка для пошуку посилань
 LINK_REGEX = re.compile(r'(https?://|t\.me/|www\.)\S+', re.IGNORECASE)
 
+# --- КЕШ АДМІНІВ ---
+# {chat_id: (set з ID адмінів, до якого часу актуально)}
+# Заповнюється одним get_chat_administrators на чат замість get_member на кожне повідомлення
+ADMIN_CACHE = {}
+ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", 300))
+_admin_fetches = {} # Запити, які вже летять (щоб 100 повідомлень не робили 100 запитів)
+
+async def get_chat_admins(chat_id: int) -> set:
+    now = asyncio.get_running_loop().time()
+    cached = ADMIN_CACHE.get(chat_id)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    fetch = _admin_fetches.get(chat_id)
+    if fetch is None:
+        fetch = asyncio.ensure_future(bot.get_chat_administrators(chat_id))
+        _admin_fetches[chat_id] = fetch
+        try:
+            members = await fetch
+            ADMIN_CACHE[chat_id] = ({m.user.id for m in members}, now + ADMIN_CACHE_TTL)
+        finally:
+            _admin_fetches.pop(chat_id, None)
+    else:
+        await fetch
+    return ADMIN_CACHE[chat_id][0]
+
+async def is_chat_admin(chat_id: int, user_id: int) -> bool:
+    return user_id in await get_chat_admins(chat_id)
+
+async def deny_not_admin(callback: CallbackQuery, chat_id: int) -> bool:
+    # chat_id у callback_data прислав клієнт, тож перед зміною налаштувань перевіряємо, що це адмін чату
+    try:
+        if await is_chat_admin(chat_id, callback.from_user.id):
+            return False
+    except Exception as e:
+        print(f"Error admin check {chat_id}: {e}")
+    try: await callback.answer("⛔ Ти не адмін цього чату.", show_alert=True)
+    except: pass
+    return True
+
+# Хтось став адміном / перестав ним бути - оновлюємо кеш без запиту до API
+@router.chat_member()
+async def on_chat_member_update(update: ChatMemberUpdated):
+    cached = ADMIN_CACHE.get(update.chat.id)
+    if not cached: return
+    if update.new_chat_member.status in ("administrator", "creator"):
+        cached[0].add(update.new_chat_member.user.id)
+    else:
+        cached[0].discard(update.new_chat_member.user.id)
+
+# --- ПОВІДОМЛЕННЯ В ЧАТ У ФОНІ ---
+# Хендлер не чекає ні на ліміт відправки в групу (~20/хв), ні на "видалити через 5 сек":
+# інакше один чат під спам-атакою тримає весь свій шард апдейтів
+_notice_tasks = set()
+
+def in_background(coro):
+    task = asyncio.create_task(coro)
+    _notice_tasks.add(task)
+    task.add_done_callback(_notice_tasks.discard)
+
+async def _delete_after(msg: Message, seconds: float):
+    await asyncio.sleep(seconds)
+    try: await msg.delete()
+    except: pass
+
+def delete_later(msg: Message, seconds: float = 5):
+    in_background(_delete_after(msg, seconds))
+
+async def _send_notice(message: Message, text: str, delete_after: float = None, **kwargs):
+    try:
+        msg = await message.answer(text, **kwargs)
+    except Exception as e:
+        print(f"Не вдалося надіслати повідомлення в чат {message.chat.id}: {e}")
+        return
+    if delete_after:
+        await _delete_after(msg, delete_after)
+
+def send_notice(message: Message, text: str, delete_after: float = None, **kwargs):
+    """message.answer у фоні (опційно з видаленням через delete_after секунд)."""
+    in_background(_send_notice(message, text, delete_after, **kwargs))
+
 # --- ФІЛЬТРИ ---
 class IsAdmin(BaseFilter):
     async def __call__(self, message: Message) -> bool:
         if message.chat.type == "private": return False
-        member = await message.chat.get_member(message.from_user.id)
-        return member.status in ("administrator", "creator")
+        return await is_chat_admin(message.chat.id, message.from_user.id)
 
 # --- ЛОГУВАННЯ В ЛІЧКУ ---
-async def send_log(message: Message, violation_type: str, action: str, file_path: str = None, is_report: bool = False):
+# Звичайні логи збираються в дайджести, важливі (бан, скарга) йдуть одразу
+log_aggregator = log_digest.LogAggregator(bot)
+
+LOG_TEXT_LIMIT = 500 # Скільки символів повідомлення порушника потрапляє в лог
+
+async def send_log(message: Message, violation_type: str, action: str, photo: bytes = None,
+                   is_report: bool = False, critical: bool = False):
     chat_id = message.chat.id
     
     # Шукаємо, кому відправити лог для цього чату
@@ -77,101 +240,303 @@ async def send_log(message: Message, violation_type: str, action: str, file_path
     
     prefix = "🚨 <b>СКАРГА (REPORT)</b>" if is_report else "🛡 <b>МОДЕРАЦІЯ</b>"
     
+    # Усе, що пише користувач, - обрізаємо до розмітки і екрануємо, щоб <, & не ламали HTML
     text = (
         f"{prefix}\n"
-        f"👤 <b>Хто:</b> {user.full_name} (<code>{user.id}</code>)\n"
-        f"🏠 <b>Де:</b> {chat.title}\n"
-        f"⚠️ <b>Що:</b> {violation_type}\n"
-        f"🔨 <b>Дія:</b> {action}"
+        f"👤 <b>Хто:</b> {html.escape(user.full_name[:100])} (<code>{user.id}</code>)\n"
+        f"🏠 <b>Де:</b> {html.escape((chat.title or '')[:100])}\n"
+        f"⚠️ <b>Що:</b> {html.escape(violation_type)}\n"
+        f"🔨 <b>Дія:</b> {html.escape(action)}"
     )
 
     if message.text:
-        text += f"\n📝 <b>Текст:</b> {message.text}"
+        text += f"\n📝 <b>Текст:</b> {html.escape(message.text[:LOG_TEXT_LIMIT])}"
 
-    try:
-        if file_path and os.path.exists(file_path):
-            await bot.send_photo(chat_id=receiver_id, photo=FSInputFile(file_path), caption=text, parse_mode="HTML")
-        else:
-            await bot.send_message(chat_id=receiver_id, text=text, parse_mode="HTML")
-    except Exception as e:
-        print(f"Не вдалося відправити лог адміну {receiver_id}: {e}")
+    await log_aggregator.add(receiver_id, text, photo, critical=critical or is_report)
 
 # --- ПОКАРАННЯ ---
-async def punish_user(message: Message, violation_type: str, file_path: str = None):
+async def punish_user(message: Message, violation_type: str, photo: bytes = None, source: str = None):
     user_id = message.from_user.id
     chat_id = message.chat.id
     name = message.from_user.full_name
     
-    w_normal, w_heavy, _ = await db.get_user_stats(user_id, chat_id)
-    
-    # Логіка оновлення варнів
-    if violation_type == "heavy": w_heavy += 1
-    else: w_normal += 1
-    
-    # Перевірка на бан
-    trigger_ban = False
-    reason = ""
-    if w_heavy >= 2:
-        trigger_ban, reason = True, "2 тяжких"
-    elif w_normal >= 3:
-        trigger_ban, reason = True, "3 звичайних"
-    elif w_heavy >= 1 and w_normal >= 2:
-        trigger_ban, reason = True, "Комбо (1 тяжке + 2 звичайних)"
-
-    # Логуємо
-    action_log = f"Попередження ({w_normal}/{w_heavy})"
-    if trigger_ban: action_log = "МУТ/БАН"
-    await send_log(message, violation_type, action_log, file_path)
-
-    # Видаляємо
+    # Один атомарний запит: додає варн, перевіряє правила бану і повертає результат
+    # (два паралельні порушення одного юзера більше не гублять оновлення)
+    # У метриках медіа рахуються окремо від тексту, хоча рівень порушення той самий ('heavy')
+    metrics.violation(source or violation_type)
+    w_normal, w_heavy, updated_temp_bans, reason = await db.apply_violation(user_id, chat_id, violation_type)
+    trigger_ban = reason is not None
+
+    # Спершу прибираємо спам і караємо - лог адміну не повинен це затримувати
     try: await message.delete()
     except: pass
 
     # Повідомляємо в чат
     msg_text = f"❗️ {name}, порушення! ({violation_type})"
-    await message.answer(msg_text)
+    send_notice(message, msg_text)
 
     if trigger_ban:
-        await db.add_temp_ban_count(user_id, chat_id)
-        _, _, updated_temp_bans = await db.get_user_stats(user_id, chat_id)
-
         if updated_temp_bans >= 3:
-            await bot.ban_chat_member(chat_id, user_id)
-            await message.answer(f"⛔️ {name} -> <b>Довічний бан</b> (3 мути).", parse_mode="HTML")
+            try:
+                await bot.ban_chat_member(chat_id, user_id)
+                send_notice(message, f"⛔️ {name} -> <b>Довічний бан</b> (3 мути).", parse_mode="HTML")
+            except Exception as e:
+                print(f"Err ban: {e}")
         else:
             mins = await db.get_ban_duration(chat_id)
             until = datetime.datetime.now() + datetime.timedelta(minutes=mins)
             try:
                 await bot.restrict_chat_member(chat_id, user_id, permissions=ChatPermissions(can_send_messages=False), until_date=until)
-                await message.answer(f"🚫 {name} -> <b>Мут на {mins} хв.</b>\nПричина: {reason}", parse_mode="HTML")
+                send_notice(message, f"🚫 {name} -> <b>Мут на {mins} хв.</b>\nПричина: {reason}", parse_mode="HTML")
             except Exception as e:
                 print(f"Err mute: {e}")
-    else:
-        await db.update_warns(user_id, chat_id, w_normal, w_heavy)
+
+    # Логуємо (критичний лог іде у фоні - ліміт ЛС адміна, ~1 повід./с, не тримає шард)
+    action_log = f"Попередження ({w_normal}/{w_heavy})"
+    if trigger_ban: action_log = "МУТ/БАН"
+    await send_log(message, violation_type, action_log, photo, critical=trigger_ban)
 
 # --- ДОПОМІЖНА ДЛЯ МЕДІА ---
-async def process_media_check(message: Message, file_id: str):
-    file_path = f"temp_photos/{file_id}.jpg" 
+# Картинки качаємо в пам'ять (без temp-файлів), тому обмежуємо розмір
+MAX_MEDIA_BYTES = int(os.getenv("MAX_MEDIA_MB", 5)) * 1024 * 1024
+
+async def download_media(file_id: str) -> bytes | None:
+    """Завантажує файл у пам'ять. Повертає None, якщо він більший за MAX_MEDIA_BYTES."""
+    file_info = await bot.get_file(file_id)
+    if file_info.file_size and file_info.file_size > MAX_MEDIA_BYTES:
+        return None
+
+    # Качаємо шматками і зупиняємось, щойно перевищили ліміт (Telegram не завжди знає розмір заздалегідь)
+    url = bot.session.api.file_url(bot.token, file_info.file_path)
+    data = bytearray()
+    async for chunk in bot.session.stream_content(url=url, timeout=30, chunk_size=65536, raise_for_status=True):
+        data += chunk
+        if len(data) > MAX_MEDIA_BYTES:
+            return None
+    return bytes(data)
+
+async def process_media_check(message: Message, file_id: str, file_unique_id: str = None):
     try:
-        file_info = await bot.get_file(file_id)
-        await bot.download_file(file_info.file_path, file_path)
-        violation = await image_checker.check_image_content(file_path)
+        # Вже бачили цю картинку? Тоді навіть не завантажуємо її
+        if file_unique_id:
+            found, violation = await image_checker.get_cached_verdict(file_unique_id)
+            if found:
+                if violation:
+                    await punish_user(message, violation, source="media")
+                    return True
+                return False
+
+        image_bytes = await download_media(file_id)
+        if not image_bytes:
+            return False
+        violation = await image_checker.check_image_content(image_bytes, file_unique_id)
         if violation:
-            await punish_user(message, violation, file_path)
+            await punish_user(message, violation, image_bytes, source="media")
             return True
     except Exception as e:
         print(f"Error media check: {e}")
-    finally:
-        if os.path.exists(file_path): os.remove(file_path)
     return False
 
+# Перевірки медіа йдуть через обмежену чергу з воркерами, щоб не гальмувати текстову модерацію
+media_checks = media_queue.MediaQueue(
+    process_media_check,
+    workers=int(os.getenv("MEDIA_WORKERS", 4)),
+    maxsize=int(os.getenv("MEDIA_QUEUE_SIZE", 200)),
+)
+
 # ==========================================
 # 1. КАПЧА (ВІТАННЯ НОВАЧКІВ)
 # ==========================================
+# Режим рейду: якщо люди заходять масово, не шлемо капчу кожному, а даємо одну спільну на всю партію
+RAID_CAPTCHA_TIMEOUT = int(os.getenv("RAID_CAPTCHA_TIMEOUT", 300)) # секунд на підтвердження
+raid = raid_guard.RaidGuard(duration=int(os.getenv("RAID_DURATION", 600)))
+
+# Протухлі капчі обробляє один планувальник таймерів (з БД), а не задача на кожного юзера
+timer_scheduler = timers.scheduler
+
+FULL_PERMISSIONS = ChatPermissions(
+    can_send_messages=True,
+    can_send_media_messages=True,
+    can_send_polls=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True,
+    can_invite_users=True
+)
+
+async def kick_user(chat_id: int, user_id: int):
+    # Кік = бан + розбан (щоб людина могла повернутись пізніше)
+    await bot.ban_chat_member(chat_id, user_id)
+    await bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
+
+_raid_locks = {} # {chat_id: asyncio.Lock} - зміни партії рейду в межах цієї копії бота по черзі (один на чат)
+
+async def save_raid_batch(chat_id: int, add=(), remove=()):
+    """
+    Партія рейду живе в таймері БД: за ним після перезапуску і на інших копіях бота знаємо,
+    хто ще має натиснути кнопку. Список у БД - головний, state.pending - його локальна копія.
+    """
+    state = raid.state(chat_id)
+    key = f"raid:{chat_id}"
+    lock = _raid_locks.setdefault(chat_id, asyncio.Lock())
+    async with lock:
+        stored = await timer_scheduler.stored(key)
+        if stored:
+            due_at, payload = stored
+            user_ids = set(payload["user_ids"])
+            message_id = state.captcha_message_id or payload["message_id"]
+            due_at = max(due_at, state.batch_expires_at)
+        else:
+            user_ids, message_id, due_at = set(state.pending), state.captcha_message_id, state.batch_expires_at
+        user_ids = (user_ids | set(add)) - set(remove)
+        state.pending, state.captcha_message_id, state.batch_expires_at = user_ids, message_id, due_at
+        await timer_scheduler.schedule(
+            key, 0, "raid_batch",
+            {"chat_id": chat_id, "message_id": message_id, "user_ids": sorted(user_ids)},
+            due_at=due_at
+        )
+
+def restore_raid_batches():
+    # Після перезапуску: відновлюємо партії рейду з таймерів
+    for _, due_at, payload in timer_scheduler.pending("raid_batch"):
+        state = raid.state(payload["chat_id"])
+        state.pending = set(payload["user_ids"])
+        state.captcha_message_id = payload["message_id"]
+        state.batch_expires_at = due_at
+
+_raid_captcha_sending = set() # Чати, куди спільна капча вже відправляється
+
+async def _mute_silently(chat_id: int, user_id: int) -> bool:
+    try:
+        await bot.restrict_chat_member(chat_id, user_id, permissions=ChatPermissions(can_send_messages=False))
+        return True
+    except Exception as e:
+        print(f"Не вдалося замутити під час рейду: {e}")
+        return False
+
+async def _unmute_all(chat_id: int, user_ids):
+    for user_id in user_ids:
+        try:
+            await bot.restrict_chat_member(chat_id, user_id, permissions=FULL_PERMISSIONS)
+        except Exception as e:
+            print(f"Не вдалося розмутити після рейду: {e}")
+
+async def _send_raid_captcha(message: Message):
+    chat_id = message.chat.id
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🤖 Я не бот", callback_data="raid_captcha")]
+    ])
+    try:
+        msg = await message.answer(
+            f"🛡 <b>Режим рейду!</b> У чат масово заходять нові учасники.\n"
+            f"Новачки, натисніть кнопку протягом {RAID_CAPTCHA_TIMEOUT // 60} хв, інакше вас буде видалено.",
+            reply_markup=kb, parse_mode="HTML"
+        )
+    except Exception as e:
+        print(f"Не вдалося надіслати капчу рейду: {e}")
+        await release_raid_batch(chat_id)
+        return
+    finally:
+        _raid_captcha_sending.discard(chat_id)
+    raid.state(chat_id).captcha_message_id = msg.message_id
+    await save_raid_batch(chat_id)
+
+async def release_raid_batch(chat_id: int):
+    # Капча так і не з'явилась у чаті: новачків не карати, а відпустити
+    stored = await timer_scheduler.stored(f"raid:{chat_id}")
+    if stored and stored[1]["message_id"]:
+        return # Іншій копії бота вдалося - партія чекає на її капчу
+    state = raid.state(chat_id)
+    user_ids = state.pending | (set(stored[1]["user_ids"]) if stored else set())
+    await timer_scheduler.cancel(f"raid:{chat_id}")
+    state.pending = set()
+    await _unmute_all(chat_id, user_ids)
+
+async def raid_join_batch(message: Message, users: list):
+    chat_id = message.chat.id
+    state = raid.state(chat_id)
+
+    # Мутимо мовчки, без окремих повідомлень, і всіх одночасно
+    muted = await asyncio.gather(*(_mute_silently(chat_id, user.id) for user in users))
+    joined = [user.id for user, ok in zip(users, muted) if ok]
+    if not joined:
+        return
+    # Кожен, хто зайшов, має щонайменше RAID_CAPTCHA_TIMEOUT - партія відсувається для пізніх новачків
+    state.batch_expires_at = max(state.batch_expires_at, time.time() + RAID_CAPTCHA_TIMEOUT)
+    # Таймер зберігаємо ще до відправки капчі, щоб замучені не лишились без нього
+    await save_raid_batch(chat_id, add=joined)
+
+    # Одна капча на всю партію; її відправка чекає ліміту чату - тому у фоні
+    if state.captcha_message_id is None and chat_id not in _raid_captcha_sending:
+        _raid_captcha_sending.add(chat_id)
+        in_background(_send_raid_captcha(message))
+
+@timer_scheduler.handler("raid_batch")
+async def expire_raid_batch(payload: dict):
+    """Час вийшов: видаляємо всіх, хто не підтвердився, і спільну капчу."""
+    chat_id = payload["chat_id"]
+    state = raid.state(chat_id)
+    # payload - збережений у БД, тож враховує входи і підтвердження на всіх копіях бота
+    pending = set(payload["user_ids"])
+    state.pending = set()
+    state.captcha_message_id = None
+
+    if not payload["message_id"]:
+        # Капчу так і не показали - нема за що видаляти
+        await _unmute_all(chat_id, pending)
+    else:
+        for user_id in pending:
+            try:
+                await kick_user(chat_id, user_id)
+            except Exception as e:
+                print(f"Не вдалося видалити після рейду: {e}")
+        try: await bot.delete_message(chat_id, payload["message_id"])
+        except: pass
+    raid.forget_idle(chat_id)
+
+@router.callback_query(F.data == "raid_captcha")
+async def on_raid_captcha_click(callback: CallbackQuery):
+    chat_id = callback.message.chat.id
+    user_id = callback.from_user.id
+    # Перевіряємо за таймером у БД: партію могла почати інша копія бота
+    stored = await timer_scheduler.stored(f"raid:{chat_id}")
+    pending = set(stored[1]["user_ids"]) if stored else raid.state(chat_id).pending
+    if user_id not in pending:
+        await callback.answer("Це кнопка не для тебе!", show_alert=True)
+        return
+    try:
+        await bot.restrict_chat_member(chat_id, user_id, permissions=FULL_PERMISSIONS)
+    except Exception as e:
+        await callback.answer(f"Помилка: {e}", show_alert=True)
+        return
+    await save_raid_batch(chat_id, remove=[user_id])
+    try: await callback.answer("Велкам! ✅")
+    except: pass
+
+@timer_scheduler.handler("captcha")
+async def expire_captcha(payload: dict):
+    """Новачок не натиснув кнопку вчасно: прибираємо капчу і (за налаштуванням чату) видаляємо його."""
+    chat_id, user_id = payload["chat_id"], payload["user_id"]
+    try: await bot.delete_message(chat_id, payload["message_id"])
+    except: pass
+
+    settings = await db.get_chat_settings(chat_id)
+    if settings['captcha_kick']:
+        try:
+            await kick_user(chat_id, user_id)
+        except Exception as e:
+            print(f"Не вдалося видалити після капчі: {e}")
+
 @router.message(F.new_chat_members)
 async def on_user_join(message: Message):
-    for user in message.new_chat_members:
-        if user.is_bot: continue
+    users = [user for user in message.new_chat_members if not user.is_bot]
+    if not users: return
+
+    settings = await db.get_chat_settings(message.chat.id)
+    if raid.register_joins(message.chat.id, len(users), settings['raid_join_limit'], settings['raid_window']):
+        await raid_join_batch(message, users)
+        return
+
+    for user in users:
         
         # Одразу даємо мут
         try:
@@ -180,18 +545,31 @@ async def on_user_join(message: Message):
                 user.id, 
                 permissions=ChatPermissions(can_send_messages=False)
             )
-            
-            # Кнопка підтвердження
-            kb = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🤖 Я не бот", callback_data=f"captcha:{user.id}")]
-            ])
-            
-            await message.answer(
-                f"👋 Привіт, {user.full_name}!\nНатисни кнопку нижче, щоб писати в чаті.", 
-                reply_markup=kb
-            )
         except Exception as e:
             print(f"Не вдалося видати капчу: {e}")
+            continue
+        # Привітання з кнопкою чекає ліміту чату - у фоні
+        in_background(send_captcha(message, user, settings['captcha_timeout']))
+
+async def send_captcha(message: Message, user, timeout: int):
+    # Кнопка підтвердження
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🤖 Я не бот", callback_data=f"captcha:{user.id}")]
+    ])
+    try:
+        msg = await message.answer(
+            f"👋 Привіт, {user.full_name}!\nНатисни кнопку нижче, щоб писати в чаті.", 
+            reply_markup=kb
+        )
+    except Exception as e:
+        print(f"Не вдалося видати капчу: {e}")
+        return
+
+    # Якщо не натисне вчасно - таймер прибере капчу
+    await timer_scheduler.schedule(
+        f"captcha:{message.chat.id}:{user.id}", timeout, "captcha",
+        {"chat_id": message.chat.id, "user_id": user.id, "message_id": msg.message_id}
+    )
 
 @router.callback_query(F.data.startswith("captcha:"))
 async def on_captcha_click(callback: CallbackQuery):
@@ -203,19 +581,16 @@ async def on_captcha_click(callback: CallbackQuery):
     
     # Знімаємо мут
     try:
-        permissions = ChatPermissions(
-            can_send_messages=True,
-            can_send_media_messages=True,
-            can_send_polls=True,
-            can_send_other_messages=True,
-            can_add_web_page_previews=True,
-            can_invite_users=True
-        )
-        await bot.restrict_chat_member(callback.message.chat.id, callback.from_user.id, permissions=permissions)
-        await callback.message.delete() # Видаляємо повідомлення з капчею
-        await callback.answer("Велкам! ✅")
+        await bot.restrict_chat_member(callback.message.chat.id, callback.from_user.id, permissions=FULL_PERMISSIONS)
     except Exception as e:
         await callback.answer(f"Помилка: {e}", show_alert=True)
+        return
+    # Мут знято - таймер більше не потрібен, навіть якщо далі щось не вдасться
+    await timer_scheduler.cancel(f"captcha:{callback.message.chat.id}:{callback.from_user.id}")
+    try: await callback.message.delete() # Видаляємо повідомлення з капчею
+    except: pass
+    try: await callback.answer("Велкам! ✅")
+    except: pass
 
 # ==========================================
 # 3. СИСТЕМА РЕПОРТІВ (/report)
@@ -227,10 +602,8 @@ async def cmd_report(message: Message):
     except: pass
 
     if not message.reply_to_message:
-        msg = await message.answer("⚠️ Пиши <code>/report</code> у відповідь на повідомлення!", parse_mode="HTML")
-        await asyncio.sleep(5)
-        try: await msg.delete()
-        except: pass
+        send_notice(message, "⚠️ Пиши <code>/report</code> у відповідь на повідомлення!",
+                    delete_after=5, parse_mode="HTML")
         return
 
     # Не можна репортити бота або адмінів
@@ -260,7 +633,7 @@ async def cmd_report(message: Message):
         except: pass
     
     # 3. Кажемо користувачу, що все ок
-    await message.answer("✅ Скарга прийнята.", delete_after=5)
+    send_notice(message, "✅ Скарга прийнята.", delete_after=5)
 
 # ==========================================
 # ВИПРАВЛЕНА АДМІН-ПАНЕЛЬ (ШВИДКА)
@@ -299,6 +672,10 @@ async def cb_menu_main(callback: CallbackQuery):
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=reports_text, callback_data=f"show_reports:{chat_id}")],
         [InlineKeyboardButton(text="⚙️ Налаштувати час бану", callback_data=f"menu_settings:{chat_id}")],
+        [InlineKeyboardButton(text="📝 Свої слова", callback_data=f"menu_words:{chat_id}")],
+        [InlineKeyboardButton(text="🌊 Анти-флуд", callback_data=f"menu_flood:{chat_id}")],
+        [InlineKeyboardButton(text="🛡 Режим рейду", callback_data=f"menu_raid:{chat_id}")],
+        [InlineKeyboardButton(text="🤖 Капча", callback_data=f"menu_captcha:{chat_id}")],
         [InlineKeyboardButton(text=f"📊 Логи в ЛС ({log_status})", callback_data=f"toggle_logs:{chat_id}")],
         [InlineKeyboardButton(text="🔙 Назад до списку", callback_data="back_to_list")]
     ])
@@ -323,20 +700,21 @@ async def cb_toggle_logs(callback: CallbackQuery):
     current_receiver = await db.get_log_receiver(chat_id)
     
     # Логіка перемикання
-    if current_receiver == user_id:
-        await db.set_log_receiver(chat_id, 0) # Вимикаємо
-    else:
-        await db.set_log_receiver(chat_id, user_id) # Вмикаємо
+    new_receiver = 0 if current_receiver == user_id else user_id # 0 - вимкнено
+    await db.set_log_receiver(chat_id, new_receiver)
 
     # Оновлюємо меню (викликаємо функцію меню вручну)
     # Але оскільки там теж є callback.answer, ми просто оновимо текст тут, щоб не було конфліктів
     
-    # Оновлюємо статус для відображення
-    new_receiver = await db.get_log_receiver(chat_id)
+    # Оновлюємо статус для відображення (без повторного запиту - ми щойно самі його записали)
     log_status = "✅ УВІМКНЕНО" if new_receiver == user_id else "❌ ВИМКНЕНО"
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⚙️ Налаштувати час бану", callback_data=f"menu_settings:{chat_id}")],
+        [InlineKeyboardButton(text="📝 Свої слова", callback_data=f"menu_words:{chat_id}")],
+        [InlineKeyboardButton(text="🌊 Анти-флуд", callback_data=f"menu_flood:{chat_id}")],
+        [InlineKeyboardButton(text="🛡 Режим рейду", callback_data=f"menu_raid:{chat_id}")],
+        [InlineKeyboardButton(text="🤖 Капча", callback_data=f"menu_captcha:{chat_id}")],
         [InlineKeyboardButton(text=f"📊 Логи в ЛС ({log_status})", callback_data=f"toggle_logs:{chat_id}")],
         [InlineKeyboardButton(text="🔙 Назад до списку", callback_data="back_to_list")]
     ])
@@ -403,6 +781,322 @@ async def cb_set_ban(callback: CallbackQuery):
         if "message is not modified" not in str(e).lower():
             print(f"Error set ban: {e}")
 
+# 6. Ліміти анти-флуду
+FLOOD_PRESETS = [(3, 10), (5, 10), (10, 10), (20, 60)]
+
+@router.callback_query(F.data.startswith("menu_flood:") | F.data.startswith("set_flood:"))
+async def cb_menu_flood(callback: CallbackQuery):
+    parts = callback.data.split(":")
+    chat_id = int(parts[1])
+    if await deny_not_admin(callback, chat_id):
+        return
+
+    saved = parts[0] == "set_flood"
+    if saved:
+        limit, seconds = int(parts[2]), int(parts[3])
+        await db.set_flood_limits(chat_id, limit, seconds)
+        flood_detector.set_limits(chat_id, limit, seconds)
+    try: await callback.answer("Збережено! ✅" if saved else None)
+    except: pass
+
+    limit, seconds = flood_detector.get_limits(chat_id)
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{l} повід. / {s} с", callback_data=f"set_flood:{chat_id}:{l}:{s}")
+         for l, s in FLOOD_PRESETS[:2]],
+        [InlineKeyboardButton(text=f"{l} повід. / {s} с", callback_data=f"set_flood:{chat_id}:{l}:{s}")
+         for l, s in FLOOD_PRESETS[2:]],
+        [InlineKeyboardButton(text="🔙 Назад в меню групи", callback_data=f"menu_main:{chat_id}")]
+    ])
+
+    try:
+        await callback.message.edit_text(
+            f"🌊 <b>Анти-флуд</b>\nМут, якщо більше <b>{limit}</b> повідомлень за <b>{int(seconds)} с</b>",
+            reply_markup=kb,
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        if "message is not modified" not in str(e).lower():
+            print(f"Error flood settings: {e}")
+
+# 7. Режим рейду
+RAID_PRESETS = [(5, 30), (10, 60), (20, 60), (50, 300)]
+
+@router.callback_query(F.data.startswith("menu_raid:") | F.data.startswith("set_raid:") | F.data.startswith("toggle_raid:"))
+async def cb_menu_raid(callback: CallbackQuery):
+    parts = callback.data.split(":")
+    action, chat_id = parts[0], int(parts[1])
+    if await deny_not_admin(callback, chat_id):
+        return
+
+    note = None
+    if action == "set_raid":
+        await db.set_raid_limits(chat_id, int(parts[2]), int(parts[3]))
+        note = "Збережено! ✅"
+    elif action == "toggle_raid":
+        raid.set_raid(chat_id, not raid.is_raid(chat_id))
+        note = "Перемкнуто ✅"
+    try: await callback.answer(note)
+    except: pass
+
+    settings = await db.get_chat_settings(chat_id)
+    if raid.is_raid(chat_id):
+        status = f"🔴 АКТИВНИЙ (ще {raid.seconds_left(chat_id) // 60} хв)\nЧекають на капчу: {len(raid.state(chat_id).pending)}"
+    else:
+        status = "🟢 Вимкнено"
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{l} входів / {w} с", callback_data=f"set_raid:{chat_id}:{l}:{w}")
+         for l, w in RAID_PRESETS[:2]],
+        [InlineKeyboardButton(text=f"{l} входів / {w} с", callback_data=f"set_raid:{chat_id}:{l}:{w}")
+         for l, w in RAID_PRESETS[2:]],
+        [InlineKeyboardButton(text="⏹ Вимкнути рейд" if raid.is_raid(chat_id) else "▶️ Увімкнути рейд зараз",
+                              callback_data=f"toggle_raid:{chat_id}")],
+        [InlineKeyboardButton(text="🔙 Назад в меню групи", callback_data=f"menu_main:{chat_id}")]
+    ])
+
+    try:
+        await callback.message.edit_text(
+            f"🛡 <b>Режим рейду</b>\nСтатус: {status}\n"
+            f"Поріг: більше <b>{settings['raid_join_limit']}</b> входів за <b>{settings['raid_window']} с</b>",
+            reply_markup=kb,
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        if "message is not modified" not in str(e).lower():
+            print(f"Error raid settings: {e}")
+
+# 8. Капча: скільки чекати і що робити з тими, хто не натиснув
+CAPTCHA_TIMEOUT_PRESETS = [60, 300, 900, 3600]
+
+@router.callback_query(F.data.startswith("menu_captcha:") | F.data.startswith("set_captcha:"))
+async def cb_menu_captcha(callback: CallbackQuery):
+    parts = callback.data.split(":")
+    chat_id = int(parts[1])
+    if await deny_not_admin(callback, chat_id):
+        return
+    settings = await db.get_chat_settings(chat_id)
+
+    saved = parts[0] == "set_captcha"
+    if saved:
+        # set_captcha:chat_id:timeout:kick
+        await db.set_captcha_settings(chat_id, int(parts[2]), parts[3] == "1")
+        settings = await db.get_chat_settings(chat_id)
+    try: await callback.answer("Збережено! ✅" if saved else None)
+    except: pass
+
+    timeout, kick = settings['captcha_timeout'], settings['captcha_kick']
+    kick_flag = "1" if kick else "0"
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"⏱ {t // 60} хв", callback_data=f"set_captcha:{chat_id}:{t}:{kick_flag}")
+         for t in CAPTCHA_TIMEOUT_PRESETS],
+        [InlineKeyboardButton(text="👢 Видаляти: ТАК" if kick else "🔇 Лишати в муті",
+                              callback_data=f"set_captcha:{chat_id}:{timeout}:{'0' if kick else '1'}")],
+        [InlineKeyboardButton(text="🔙 Назад в меню групи", callback_data=f"menu_main:{chat_id}")]
+    ])
+
+    try:
+        await callback.message.edit_text(
+            f"🤖 <b>Капча</b>\nЧас на підтвердження: <b>{timeout // 60} хв</b>\n"
+            f"Хто не встиг: <b>{'видаляється з чату' if kick else 'лишається в муті'}</b>",
+            reply_markup=kb,
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        if "message is not modified" not in str(e).lower():
+            print(f"Error captcha settings: {e}")
+
+# 9. Свої слова чату (додаткові корені і винятки)
+class WordsForm(StatesGroup):
+    waiting_root = State()
+
+WORD_KIND_TITLES = {"heavy": "🤬 Тяжкі", "normal": "📢 Звичайні", "exempt": "✅ Винятки"}
+MAX_ROOT_LENGTH = 50   # Символів в одному корені
+WORDS_MENU_PAGE = 40   # Коренів на одній сторінці меню (щоб текст влазив у 4096 символів)
+
+async def reload_chat_words(chat_id: int):
+    # Перечитуємо список чату з БД і скидаємо його скомпільований автомат
+    rows = await db.get_chat_words(chat_id)
+    lists = {kind: [r['root'] for r in rows if r['kind'] == kind] for kind in word_list.WORD_KINDS}
+    word_list.set_chat_words(chat_id, lists["heavy"], lists["normal"], lists["exempt"])
+    return rows
+
+# Зміни, зроблені іншою копією бота (приходять через LISTEN/NOTIFY)
+_reload_tasks = set()
+
+async def reload_chat_settings(chat_id: int):
+    settings = await db.get_chat_settings(chat_id)
+    flood_detector.set_limits(chat_id, settings['flood_limit'], settings['flood_time'])
+
+async def reload_all_from_db():
+    # Після обриву LISTEN: сповіщення могли загубитись, тож перечитуємо всі списки і ліміти
+    rows = await db.get_all_chat_words()
+    for chat_id in set(word_list.CHAT_WORDS) - {row[0] for row in rows}:
+        word_list.set_chat_words(chat_id)
+    word_list.load_chat_words(rows)
+    for row in await db.get_all_flood_limits():
+        flood_detector.set_limits(row['chat_id'], row['flood_limit'], row['flood_time'])
+
+def on_db_change(kind: str, chat_id: int):
+    if kind == "words":
+        task = asyncio.create_task(reload_chat_words(chat_id))
+    elif kind == "settings":
+        task = asyncio.create_task(reload_chat_settings(chat_id))
+    elif kind == "resync":
+        task = asyncio.create_task(reload_all_from_db())
+    else:
+        return
+    _reload_tasks.add(task)
+    task.add_done_callback(_reload_tasks.discard)
+
+db.change_listeners.append(on_db_change)
+
+@router.callback_query(F.data.startswith("menu_words:"))
+async def cb_menu_words(callback: CallbackQuery, state: FSMContext):
+    parts = callback.data.split(":")
+    chat_id = int(parts[1])
+    page = int(parts[2]) if len(parts) > 2 else 0
+    if await deny_not_admin(callback, chat_id):
+        return
+    try: await callback.answer()
+    except: pass
+    await state.clear()
+    rows = await db.get_chat_words(chat_id)
+    pages = max(1, -(-len(rows) // WORDS_MENU_PAGE))
+    page = min(max(page, 0), pages - 1)
+    shown = rows[page * WORDS_MENU_PAGE:(page + 1) * WORDS_MENU_PAGE]
+
+    # Лічильники - за всім списком, самі корені - лише поточної сторінки
+    text = "📝 <b>Свої слова чату</b>\n" + " · ".join(
+        f"{title}: {sum(r['kind'] == kind for r in rows)}" for kind, title in WORD_KIND_TITLES.items())
+    if pages > 1:
+        text += f"\nСторінка {page + 1}/{pages}"
+    for kind, title in WORD_KIND_TITLES.items():
+        roots = [r['root'] for r in shown if r['kind'] == kind]
+        if roots:
+            text += f"\n\n{title}: " + ", ".join(f"<code>{html.escape(r)}</code>" for r in roots)
+
+    keyboard = [
+        [InlineKeyboardButton(text="➕ Тяжке", callback_data=f"word_add:{chat_id}:heavy"),
+         InlineKeyboardButton(text="➕ Звичайне", callback_data=f"word_add:{chat_id}:normal"),
+         InlineKeyboardButton(text="➕ Виняток", callback_data=f"word_add:{chat_id}:exempt")],
+    ]
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"menu_words:{chat_id}:{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"menu_words:{chat_id}:{page + 1}"))
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton(text="🗑 Видалити слово", callback_data=f"word_del_menu:{chat_id}")])
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад в меню групи", callback_data=f"menu_main:{chat_id}")])
+    kb = InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+    try:
+        await callback.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    except Exception as e:
+        if "message is not modified" not in str(e).lower():
+            print(f"Error words menu: {e}")
+
+@router.callback_query(F.data.startswith("word_add:"))
+async def cb_word_add(callback: CallbackQuery, state: FSMContext):
+    _, chat_id, kind = callback.data.split(":")
+    if kind not in WORD_KIND_TITLES or await deny_not_admin(callback, int(chat_id)):
+        return
+    await state.set_state(WordsForm.waiting_root)
+    await state.update_data(chat_id=int(chat_id), kind=kind)
+    await callback.answer()
+    await callback.message.answer(f"✍️ Надішли корінь для списку «{WORD_KIND_TITLES[kind]}» (або /cancel).")
+
+@router.message(WordsForm.waiting_root, F.chat.type == "private")
+async def on_word_root(message: Message, state: FSMContext):
+    data = await state.get_data()
+    await state.clear()
+    if not message.text or message.text.startswith("/"):
+        return await message.answer("Скасовано.")
+
+    root = message.text.strip().lower()
+    if not word_list.prepare_root(root):
+        return await message.answer("⚠️ Порожній корінь, спробуй ще раз через меню.")
+    if len(root) > MAX_ROOT_LENGTH:
+        return await message.answer(f"⚠️ Корінь довший за {MAX_ROOT_LENGTH} символів, спробуй ще раз через меню.")
+    # Адміна могли розжалувати, поки він писав слово
+    try: allowed = await is_chat_admin(data["chat_id"], message.from_user.id)
+    except: allowed = False
+    if not allowed:
+        return await message.answer("⛔ Ти не адмін цього чату.")
+
+    await db.add_chat_word(data["chat_id"], root, data["kind"])
+    await reload_chat_words(data["chat_id"])
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📝 До списку слів", callback_data=f"menu_words:{data['chat_id']}")]
+    ])
+    await message.answer(f"✅ <code>{html.escape(root)}</code> додано.", reply_markup=kb, parse_mode="HTML")
+
+WORDS_PAGE_SIZE = 10 # Кнопок видалення на одній сторінці
+
+def word_key(root: str) -> str:
+    # У callback_data лише 64 байти, тому замість кореня - короткий хеш (а не індекс, що зсувається)
+    return hashlib.sha1(root.encode()).hexdigest()[:10]
+
+@router.callback_query(F.data.startswith("word_del_menu:"))
+async def cb_word_del_menu(callback: CallbackQuery):
+    parts = callback.data.split(":")
+    chat_id = int(parts[1])
+    page = int(parts[2]) if len(parts) > 2 else 0
+    if await deny_not_admin(callback, chat_id):
+        return
+    try: await callback.answer()
+    except: pass
+    await show_word_del_menu(callback.message, chat_id, page)
+
+async def show_word_del_menu(message: Message, chat_id: int, page: int):
+    rows = await db.get_chat_words(chat_id)
+    pages = max(1, -(-len(rows) // WORDS_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    start = page * WORDS_PAGE_SIZE
+
+    keyboard = [[InlineKeyboardButton(text=f"🗑 {r['root']}", callback_data=f"word_del:{chat_id}:{word_key(r['root'])}:{page}")]
+                for r in rows[start:start + WORDS_PAGE_SIZE]]
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"word_del_menu:{chat_id}:{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"word_del_menu:{chat_id}:{page + 1}"))
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data=f"menu_words:{chat_id}")])
+
+    text = "Обери слово для видалення:" + (f" (сторінка {page + 1}/{pages})" if pages > 1 else "")
+    try:
+        await message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
+    except Exception as e:
+        if "message is not modified" not in str(e).lower():
+            print(f"Error words delete menu: {e}")
+
+@router.callback_query(F.data.startswith("word_del:"))
+async def cb_word_del(callback: CallbackQuery):
+    parts = callback.data.split(":")
+    if len(parts) != 4:
+        # Кнопка зі старого меню (видалення за індексом) - просимо відкрити меню заново
+        try: await callback.answer("Меню застаріло, відкрий його ще раз.", show_alert=True)
+        except: pass
+        return
+    _, chat_id, key, page = parts
+    chat_id = int(chat_id)
+    if await deny_not_admin(callback, chat_id):
+        return
+
+    # Шукаємо корінь за хешем у свіжому списку: якщо меню застаріло, видалиться саме той корінь або нічого
+    rows = await db.get_chat_words(chat_id)
+    root = next((r['root'] for r in rows if word_key(r['root']) == key), None)
+    if root is not None:
+        await db.delete_chat_word(chat_id, root)
+        await reload_chat_words(chat_id)
+    try: await callback.answer("Видалено ✅" if root is not None else None)
+    except: pass
+    await show_word_del_menu(callback.message, chat_id, int(page))
+
 
 @router.callback_query(F.data == "back_to_start")
 async def cb_back_start(callback: CallbackQuery):
@@ -637,10 +1331,10 @@ async def cmd_start(message: Message):
 # 💎 ПРЕМІУМ ФУНКЦІЇ (ANTI-FLOOD & CLEANER)
 # ==========================================
 
-# Кеш для анти-флуду: зберігає час повідомлень {user_id: [time1, time2...]}
-FLOOD_CACHE = {} 
-FLOOD_LIMIT = 5   # Максимум повідомлень
+# Анти-флуд: кільцевий буфер на кожну пару (чат, юзер), ліміти чатів беруться з settings
+FLOOD_LIMIT = 5   # Максимум повідомлень (за замовчуванням)
 FLOOD_TIME = 10   # За скільки секунд (вікно перевірки)
+flood_detector = flood_control.FloodDetector(FLOOD_LIMIT, FLOOD_TIME)
 
 async def check_flood(message: Message) -> bool:
     """
@@ -649,22 +1343,11 @@ async def check_flood(message: Message) -> bool:
     """
     user_id = message.from_user.id
     chat_id = message.chat.id
-    now = datetime.datetime.now().timestamp()
-
-    # Якщо користувача немає в кеші - створюємо список
-    if user_id not in FLOOD_CACHE:
-        FLOOD_CACHE[user_id] = []
-
-    # Додаємо час поточного повідомлення
-    FLOOD_CACHE[user_id].append(now)
 
-    # Залишаємо тільки свіжі повідомлення (не старші за FLOOD_TIME)
-    FLOOD_CACHE[user_id] = [t for t in FLOOD_CACHE[user_id] if now - t < FLOOD_TIME]
-
-    # Перевіряємо кількість
-    if len(FLOOD_CACHE[user_id]) > FLOOD_LIMIT:
+    if flood_detector.hit(chat_id, user_id):
         # Очищаємо кеш, щоб не банити його знову кожну секунду
-        FLOOD_CACHE[user_id] = []
+        flood_detector.reset(chat_id, user_id)
+        metrics.violation("flood")
         
         try:
             # Видаємо МУТ на 10 хвилин
@@ -675,9 +1358,7 @@ async def check_flood(message: Message) -> bool:
             await bot.restrict_chat_member(chat_id, user_id, permissions=permissions, until_date=until)
             
             # Повідомляємо (і видаляємо це повідомлення через 5 сек)
-            msg = await message.answer(f"🌊 {message.from_user.full_name}, не флуди! Охолонь {mins} хв.")
-            await asyncio.sleep(5)
-            await msg.delete()
+            send_notice(message, f"🌊 {message.from_user.full_name}, не флуди! Охолонь {mins} хв.", delete_after=5)
             return True # Флуд виявлено
             
         except Exception as e:
@@ -733,20 +1414,34 @@ async def process_pre_checkout(pre_checkout_query: PreCheckoutQuery):
 async def process_successful_payment(message: Message):
     payment_info = message.successful_payment
     
-    # Видаємо преміум на 30 днів
-    await db.set_premium(message.from_user.id, 30)
+    # Видаємо преміум на 30 днів. Ключ - charge id від Telegram, тож повторний апдейт не продовжить двічі
+    until, is_new = await db.grant_premium_payment(
+        payment_info.telegram_payment_charge_id, message.from_user.id, 30,
+        payment_info.total_amount, payment_info.currency
+    )
+    if not is_new:
+        print(f"Duplicate payment {payment_info.telegram_payment_charge_id} from {message.from_user.id}")
+        return
+    until_text = datetime.datetime.fromtimestamp(until).strftime("%d.%m.%Y %H:%M")
     
     await message.answer(
         f"🎉 <b>Оплата пройшла успішно!</b>\n"
         f"Сума: {payment_info.total_amount / 100} {payment_info.currency}\n\n"
-        f"✅ Premium активовано до {datetime.datetime.now() + datetime.timedelta(days=30)}.\n"
-        f"Тепер спробуйте команду <code>/stats</code> у групі!",
+        f"✅ Premium активовано до {until_text}.\n"
+        f"Тепер спробуйте команду <code>/stats</code> у групі!\n"
+        f"Також: <code>/stats week</code>, <code>month</code>, <code>activity</code>, <code>heatmap</code>",
         parse_mode="HTML"
     )
 
 # ==========================================
 # 📊 СТАТИСТИКА (Тільки для Premium)
 # ==========================================
+# Скільки годин історії бере кожен режим /stats
+# Теплова карта бере лише погодинні дані, тож не довше, ніж їх зберігає БД (цілими тижнями, щоб дні тижня були рівні)
+HEATMAP_HOURS = (db.ACTIVITY_HOURLY_DAYS // 7 * 7 or db.ACTIVITY_HOURLY_DAYS) * 24
+STATS_MODES = {"week": 7 * 24, "month": 30 * 24, "activity": 30 * 24, "heatmap": HEATMAP_HOURS}
+STATS_TZ = os.getenv("STATS_TZ", "Europe/Kyiv") # Часовий пояс для днів і годин на графіках
+
 @router.message(Command("stats"))
 async def cmd_stats(message: Message):
     # Працює тільки в групах
@@ -771,29 +1466,40 @@ async def cmd_stats(message: Message):
         return
 
     # 2. Генеруємо графік
+    # /stats [week|month|activity|heatmap] - без аргументу топ за весь час
+    parts = message.text.split(maxsplit=1)
+    mode = parts[1].strip().lower() if len(parts) > 1 else ""
+    if mode and mode not in STATS_MODES:
+        return await message.answer("Використання: /stats [week | month | activity | heatmap]")
+
     wait_msg = await message.answer("📊 Збираю дані та малюю графік...")
     
     try:
+        chat_id = message.chat.id
+        title = f"Активність: {message.chat.title}"
         # Отримуємо дані з БД
-        top_data = await db.get_top_talkers(message.chat.id, limit=7)
+        if mode in ("week", "month"):
+            chart, caption = "create_chart", f"📈 Топ найактивніших за {'тиждень' if mode == 'week' else 'місяць'}."
+            args = (await db.get_top_talkers_since(chat_id, STATS_MODES[mode], limit=7), title)
+        elif mode in ("activity", "heatmap"):
+            chart = "create_activity_chart" if mode == "activity" else "create_heatmap"
+            caption = "📅 Повідомлення по днях." if mode == "activity" else "🕒 Коли чат найактивніший."
+            args = (await db.get_chat_activity(chat_id, STATS_MODES[mode]), title, STATS_TZ)
+        else:
+            chart, caption = "create_chart", "📈 Топ найактивніших учасників."
+            args = (await db.get_top_talkers(chat_id, limit=7), title)
         
-        if not top_data:
+        if not args[0]:
             await wait_msg.edit_text("📉 У чаті поки немає активності.")
             return
 
-        # Малюємо (це синхронна операція, тому запускаємо в executor, щоб не блокувати бота)
-        loop = asyncio.get_running_loop()
-        photo_bytes = await loop.run_in_executor(
-            None, 
-            analytics.create_chart, 
-            top_data, 
-            f"Активність: {message.chat.title}"
-        )
+        # Малюємо в окремому процесі (або беремо з кешу, якщо дані не змінились)
+        photo_bytes = await chart_renderer.renderer.render(chat_id, chart, *args)
         
         if photo_bytes:
             # Відправляємо картинку
-            file = BufferedInputFile(photo_bytes.read(), filename="stats.png")
-            await message.answer_photo(file, caption="📈 Топ найактивніших учасників.")
+            file = BufferedInputFile(photo_bytes, filename="stats.png")
+            await message.answer_photo(file, caption=caption)
             await wait_msg.delete()
         else:
             await wait_msg.edit_text("Помилка генерації графіка.")
@@ -820,8 +1526,7 @@ async def global_listener(message: Message):
     await db.increment_message_count(message.from_user.id, message.chat.id)
 
     # Отримуємо статус користувача (адмін чи ні)
-    member = await message.chat.get_member(message.from_user.id)
-    is_admin = member.status in ("administrator", "creator")
+    is_admin = await is_chat_admin(message.chat.id, message.from_user.id)
 
     # --- 🛡 АНТИ-ФЛУД (Тільки для звичайних користувачів) ---
     if not is_admin:
@@ -838,46 +1543,120 @@ async def global_listener(message: Message):
     if message.text or message.caption:
         txt = message.text or message.caption
         if LINK_REGEX.search(txt):
+            metrics.violation("link")
             try: await message.delete()
             except: pass
             
-            msg = await message.answer(f"⚠️ {message.from_user.full_name}, посилання заборонені!", delete_after=5)
+            send_notice(message, f"⚠️ {message.from_user.full_name}, посилання заборонені!", delete_after=5)
             return 
 
     # --- 🤬 ТЕКСТ (Перевірка на мати) ---
     if message.text:
-        violation = word_list.check_text_violation(message.text)
+        violation = word_list.check_text_violation(message.text, message.chat.id)
         if violation:
             # Функція punish_user має бути визначена вище
             await punish_user(message, violation)
             return
 
     # --- 🔞 МЕДІА (AI Перевірка фото/стікерів) ---
-    file_id = None
+    media = None
     if message.photo: 
-        file_id = message.photo[-1].file_id
+        media = message.photo[-1]
     elif message.sticker: 
         # Беремо thumbnail (статичну картинку), якщо є
-        file_id = message.sticker.thumbnail.file_id if message.sticker.thumbnail else message.sticker.file_id
+        media = message.sticker.thumbnail if message.sticker.thumbnail else message.sticker
     elif message.animation and message.animation.thumbnail:
-        file_id = message.animation.thumbnail.file_id
-
-    if file_id:
-        # Функція process_media_check має бути визначена вище
-        await process_media_check(message, file_id)
+        media = message.animation.thumbnail
+
+    if media:
+        # Не чекаємо AI - віддаємо в чергу; якщо вона переповнена, картинку пропускаємо
+        if not media_checks.submit(message, media.file_id, media.file_unique_id):
+            print(f"Media queue is full, skipping check in chat {message.chat.id}")
+
+# --- ЧАС СТАРТУ ---
+# Розбивка по етапах (у /status і в лог), щоб було видно, що гальмує холодний старт
+STARTUP_TIMES = {} # {етап: секунд}
+_stage_started = _PROCESS_START
+WARM_UP_DELAY = float(os.getenv("WARM_UP_DELAY", 5)) # секунд після старту до фонового прогріву
+
+def startup_mark(stage: str):
+    global _stage_started
+    now = time.monotonic()
+    STARTUP_TIMES[stage] = round(now - _stage_started, 3)
+    _stage_started = now
+
+def report_first_update():
+    STARTUP_TIMES["first_update_total"] = round(time.monotonic() - _PROCESS_START, 3)
+    print("⏱ Час старту: " + ", ".join(f"{stage} {sec:.2f}s" for stage, sec in STARTUP_TIMES.items()))
+
+update_dispatch.on_first_update = report_first_update
+
+async def warm_up():
+    # Те, що не потрібно для першого апдейту, вантажимо вже після запуску
+    await asyncio.sleep(WARM_UP_DELAY)
+    start = time.monotonic()
+    try:
+        await image_checker.load_bad_hashes()
+    except Exception as e:
+        print(f"Не вдалося завантажити хеші медіа: {e}")
+    STARTUP_TIMES["warm_bad_hashes"] = round(time.monotonic() - start, 3)
+    await chart_renderer.renderer.warm_up()
+    if chart_renderer.renderer.warm_up_seconds is not None:
+        STARTUP_TIMES["warm_charts"] = round(chart_renderer.renderer.warm_up_seconds, 3)
 
 async def main():
+    startup_mark("imports")
+    if WEBHOOK_MODE and not (WEBHOOK_URL and WEBHOOK_SECRET):
+        raise RuntimeError("UPDATES_MODE=webhook потребує WEBHOOK_URL і WEBHOOK_SECRET")
     # 1. Ініціалізація БД (Тільки один раз!)
     await db.init_db()
+    startup_mark("init_db")
+    # Свої слова всіх чатів вантажимо один раз, далі повідомлення БД не чіпають
+    word_list.load_chat_words(await db.get_all_chat_words())
+    await db.load_premium()
+    for row in await db.get_all_flood_limits():
+        flood_detector.set_limits(row['chat_id'], row['flood_limit'], row['flood_time'])
+    startup_mark("load_settings")
     
+    media_checks.start()
+    update_dispatch.start()
+    # Таймери капч, що лишились з минулого запуску
+    await timer_scheduler.load()
+    restore_raid_batches()
+    timer_scheduler.start()
+    startup_mark("timers")
+
     # 2. Запуск веб-сервера (для Koyeb)
     await start_web_server()
+    startup_mark("web_server")
     
     print("Бот (v4.0 Full Pack + Neon DB) запущено...")
+    # Хеші медіа і пул графіків - у фоні, коли бот уже приймає апдейти
+    warm_up_task = asyncio.create_task(warm_up())
     
-    # 3. Видаляємо вебхук (на всяк випадок) і запускаємо
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    try:
+        # chat_member потрібен для кешу адмінів, тому просимо всі типи, які реально обробляємо.
+        if WEBHOOK_MODE:
+            # 3. Реєструємо вебхук (кожна копія ставить той самий - це безпечно) і просто працюємо
+            await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=dp.resolve_used_update_types())
+            print(f"Webhook mode: {WEBHOOK_URL}{WEBHOOK_PATH}")
+            await asyncio.Event().wait()
+        else:
+            # 3. Видаляємо вебхук (на всяк випадок) і запускаємо polling.
+            # handle_as_tasks=False: polling лише кладе апдейти в черги шардів і чекає, коли ті переповнені
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types(), handle_as_tasks=False)
+    finally:
+        warm_up_task.cancel()
+        await update_dispatch.stop()
+        # Дописуємо буферизовані лічильники перед виходом
+        await media_checks.stop()
+        await timer_scheduler.stop()
+        await log_aggregator.flush_all()
+        await db.close_db()
+        await image_checker.close()
+        chart_renderer.renderer.close()
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
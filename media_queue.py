@@ -0,0 +1,125 @@
+# media_queue.py
+import asyncio
+import time
+from collections import deque
+
+
+class CircuitBreaker:
+    """
+    Запобіжник для зовнішнього API.
+    closed    - все добре, запити йдуть;
+    open      - забагато помилок, запити не робимо cooldown секунд;
+    half_open - пробуємо один запит: успіх закриває запобіжник, помилка знову відкриває.
+    """
+
+    def __init__(self, failure_ratio: float = 0.5, min_calls: int = 10,
+                 window: int = 50, cooldown: float = 60):
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.opened_total = 0
+        self.skipped_total = 0
+        self._results = deque(maxlen=window) # True - успіх, False - помилка
+        self._opened_at = 0.0
+        self._probe_running = False
+
+    def allow(self) -> bool:
+        """Чи можна зараз робити запит."""
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.cooldown:
+                self.skipped_total += 1
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probe_running:
+                self.skipped_total += 1
+                return False
+            self._probe_running = True
+        return True
+
+    def record(self, success: bool):
+        if self.state == "half_open":
+            self._probe_running = False
+            if success:
+                self.state = "closed"
+                self._results.clear()
+            else:
+                self._open()
+            return
+
+        self._results.append(success)
+        if len(self._results) >= self.min_calls:
+            failures = self._results.count(False)
+            if failures / len(self._results) >= self.failure_ratio:
+                self._open()
+
+    def _open(self):
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self.opened_total += 1
+        self._results.clear()
+
+    def stats(self) -> dict:
+        return {
+            "breaker_state": self.state,
+            "breaker_opened_total": self.opened_total,
+            "breaker_skipped_total": self.skipped_total,
+        }
+
+
+class MediaQueue:
+    """
+    Обмежена черга перевірок медіа з пулом воркерів.
+    Обробник повідомлень лише кладе завдання в чергу і йде далі, тож текстова модерація
+    не чекає на AI. Якщо черга повна - завдання відкидається (backpressure), а не копиться без ліміту.
+    """
+
+    def __init__(self, handler, workers: int = 4, maxsize: int = 200):
+        self.handler = handler
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped_total = 0
+        self.processed_total = 0
+        self.failed_total = 0
+        self._tasks = []
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, *args) -> bool:
+        """Кладе завдання в чергу. Повертає False, якщо черга переповнена."""
+        try:
+            self.queue.put_nowait(args)
+            return True
+        except asyncio.QueueFull:
+            self.dropped_total += 1
+            return False
+
+    async def _worker(self):
+        while True:
+            args = await self.queue.get()
+            try:
+                await self.handler(*args)
+                self.processed_total += 1
+            except Exception as e:
+                self.failed_total += 1
+                print(f"Error media worker: {e}")
+            finally:
+                self.queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "media_queue_depth": self.queue.qsize(),
+            "media_queue_capacity": self.queue.maxsize,
+            "media_queue_dropped_total": self.dropped_total,
+            "media_queue_processed_total": self.processed_total,
+            "media_queue_failed_total": self.failed_total,
+        }
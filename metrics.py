@@ -0,0 +1,173 @@
+# metrics.py
+import functools
+import os
+import time
+from aiogram import BaseMiddleware
+
+# Метрики у форматі Prometheus для /metrics.
+# Бот працює в одному потоці asyncio, тому лічильники - звичайні dict без блокувань.
+# METRICS_ENABLED=0 вимикає збір повністю: декоратори повертають функцію як є.
+ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry = []       # Усі Counter/Histogram у порядку створення
+_gauge_sources = []  # Функції, що повертають {name: число або рядок-стан} на момент запиту
+_labelled_sources = [] # Функції, що повертають [(name, {label: value}, число), ...]
+
+
+def _label_str(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self._values = {} # {(label values): число}
+        _registry.append(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} counter"
+        for values, count in self._values.items():
+            yield f"{self.name}{_label_str(self.labels, values)} {count}"
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        self._values = {} # {(label values): [лічильники по бакетах..., +Inf, сума]}
+        _registry.append(self)
+
+    def observe(self, value: float, *label_values):
+        row = self._values.get(label_values)
+        if row is None:
+            row = self._values[label_values] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                row[i] += 1
+                break
+        else:
+            row[-2] += 1
+        row[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} histogram"
+        names = self.labels + ("le",)
+        for values, row in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), row):
+                cumulative += count
+                yield f"{self.name}_bucket{_label_str(names, values + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{_label_str(self.labels, values)} {row[-1]:.6f}"
+            yield f"{self.name}_count{_label_str(self.labels, values)} {cumulative}"
+
+
+def register_gauges(source):
+    """
+    source() -> {name: значення}; викликається лише під час запиту /metrics.
+    Рядкове значення (стан, напр. breaker_state='open') стає gauge з міткою state і значенням 1.
+    """
+    _gauge_sources.append(source)
+
+
+def register_labelled_gauges(source):
+    """source() -> [(name, {мітка: значення}, число), ...] - gauge з мітками (напр. по шардах)."""
+    _labelled_sources.append(source)
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for source in _gauge_sources:
+        for name, value in source().items():
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                lines.append(f"# TYPE bot_{name} gauge")
+                lines.append(f"bot_{name} {value}")
+            elif isinstance(value, str):
+                lines.append(f"# TYPE bot_{name} gauge")
+                lines.append(f'bot_{name}{_label_str(("state",), (value,))} 1')
+    # Рядки однієї метрики мають іти підряд - групуємо за назвою
+    grouped = {}
+    for source in _labelled_sources:
+        for name, labels, value in source():
+            grouped.setdefault(name, []).append(
+                f"bot_{name}{_label_str(tuple(labels), tuple(labels.values()))} {value}")
+    for name, samples in grouped.items():
+        lines.append(f"# TYPE bot_{name} gauge")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+# --- Метрики бота ---
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Handler latency", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handler exceptions", ("handler",))
+DB_SECONDS = Histogram("bot_db_query_seconds", "Database query latency", ("function",))
+DB_ERRORS = Counter("bot_db_query_errors_total", "Database query errors", ("function",))
+TG_CALLS = Counter("bot_telegram_calls_total", "Telegram API calls", ("method",))
+TG_ERRORS = Counter("bot_telegram_errors_total", "Telegram API errors", ("method",))
+VIOLATIONS = Counter("bot_violations_total", "Detected violations", ("type",))
+CHART_SECONDS = Histogram("bot_chart_render_seconds", "Chart render latency", ("chart",))
+
+
+def timed(histogram: Histogram, errors: Counter = None):
+    """Декоратор для корутин: час виконання з міткою = ім'я функції."""
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+        label = fn.__name__
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                if errors:
+                    errors.inc(label)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start, label)
+        return wrapper
+    return decorator
+
+
+def violation(kind: str):
+    if ENABLED:
+        VIOLATIONS.inc(kind)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware роутера: міряє кожен хендлер окремо (мітка - ім'я функції)."""
+
+    async def __call__(self, handler, event, data):
+        handler_obj = data.get("handler")
+        label = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(label)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, label)
+
+
+def setup_router(router):
+    """Підключає заміри до всіх типів подій роутера."""
+    if not ENABLED:
+        return
+    middleware = HandlerMetricsMiddleware()
+    for name, observer in router.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(middleware)
@@ -0,0 +1,258 @@
+# outbound.py
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import time
+from contextlib import contextmanager
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import GetUpdates
+import metrics
+
+# Смуги пріоритету: менше число - раніше піде
+PRIORITY_CRITICAL = 0 # бани, мути, видалення, відповіді на кнопки
+PRIORITY_NORMAL = 1   # повідомлення в чат
+PRIORITY_LOW = 2      # логи адмінам
+
+# Дії модерації: ідуть першими і не чекають на ліміт чату (лише на глобальний)
+CRITICAL_METHODS = {
+    "BanChatMember", "UnbanChatMember", "RestrictChatMember", "DeleteMessage",
+    "DeleteMessages", "AnswerCallbackQuery", "AnswerPreCheckoutQuery",
+    "GetChatAdministrators", "GetFile",
+}
+
+# Ліміти Telegram: ~30 повідомлень/с загалом, ~20/хв у групу, ~1/с в особисті
+GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 30))
+GROUP_RATE = float(os.getenv("TG_GROUP_RATE_PER_MIN", 20)) / 60
+PRIVATE_RATE = float(os.getenv("TG_PRIVATE_RATE", 1))
+MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 3))
+
+# Пріоритет, заданий явно (наприклад, для логів) - див. with_priority()
+_priority_override = contextvars.ContextVar("outbound_priority", default=None)
+
+
+@contextmanager
+def with_priority(priority: int):
+    """Усі виклики API всередині блоку йдуть з цим пріоритетом."""
+    token = _priority_override.set(priority)
+    try:
+        yield
+    finally:
+        _priority_override.reset(token)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Скільки секунд чекати до наступного токена (0 - можна зараз)."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        # Telegram сказав retry_after - нічого не шлемо до цього часу
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class OutboundScheduler:
+    """
+    Черга вихідних викликів API з пріоритетами і token bucket на кожен чат та глобально.
+    Запити одного чату чекають лише на свій ліміт і не блокують інші чати.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self._buckets = {}       # {chat_id: TokenBucket}
+        self._chats = {}         # {chat_id: heap [(priority, seq, future)]}
+        self._ready = []         # heap [(priority, seq, chat_id)] - голови черг чатів, яким можна слати
+        self._delayed = []       # heap [(коли можна, chat_id)] - чати, що вичерпали ліміт
+        self._delayed_chats = set()
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._next_sweep = 0.0
+        self.waiting_by_priority = [0, 0, 0]
+        self.throttled_total = 0
+        self.retry_after_total = 0
+        self.errors_total = 0
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(PRIVATE_RATE, 3)
+            else:
+                bucket = TokenBucket(GROUP_RATE, 20)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    async def acquire(self, priority: int, chat_id=None):
+        """Чекає своєї черги на відправку."""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch())
+
+        fut = asyncio.get_running_loop().create_future()
+        seq = next(self._seq)
+        queue = self._chats.setdefault(chat_id, [])
+        heapq.heappush(queue, (priority, seq, fut))
+        if queue[0][1] == seq and chat_id not in self._delayed_chats:
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+        self.waiting_by_priority[priority] += 1
+        self._wakeup.set()
+        try:
+            await fut
+        finally:
+            self.waiting_by_priority[priority] -= 1
+
+    def pause(self, chat_id, seconds: float):
+        # retry_after одного чату зупиняє лише цей чат; глобально - тільки для викликів без чату
+        self.retry_after_total += 1
+        (self._bucket(chat_id) if chat_id is not None else self.global_bucket).pause(seconds)
+
+    def pause_left(self, chat_id) -> float:
+        """Скільки ще чат на паузі після retry_after (0 - не на паузі)."""
+        bucket = self._buckets.get(chat_id)
+        return max(0.0, bucket.paused_until - time.monotonic()) if bucket else 0.0
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            if now >= self._next_sweep:
+                self._sweep_buckets(now)
+            # Чати, в яких відновився ліміт, повертаємо в чергу готових
+            while self._delayed and self._delayed[0][0] <= now:
+                _, chat_id = heapq.heappop(self._delayed)
+                self._delayed_chats.discard(chat_id)
+                self._push_head(chat_id)
+
+            if not self._ready:
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            global_delay = self.global_bucket.delay(now)
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+                continue
+
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            queue = self._chats.get(chat_id)
+            if not queue or queue[0][1] != seq:
+                continue # Застарілий запис: голова черги чату вже інша
+
+            # Дії модерації (chat_id=None) обмежені лише глобальним лімітом
+            if chat_id is not None:
+                chat_delay = self._bucket(chat_id).delay(now)
+                if chat_delay > 0:
+                    self.throttled_total += 1
+                    heapq.heappush(self._delayed, (now + chat_delay, chat_id))
+                    self._delayed_chats.add(chat_id)
+                    continue
+                self._bucket(chat_id).take()
+
+            _, _, fut = heapq.heappop(queue)
+            if fut.done():
+                # Той, хто чекав, уже скасований - токен не витрачаємо
+                if chat_id is not None:
+                    self._bucket(chat_id).tokens += 1
+            else:
+                self.global_bucket.take()
+                fut.set_result(None)
+            self._push_head(chat_id)
+
+    def _push_head(self, chat_id):
+        queue = self._chats.get(chat_id)
+        if queue:
+            heapq.heappush(self._ready, (queue[0][0], queue[0][1], chat_id))
+            return
+        self._chats.pop(chat_id, None)
+
+    def _sweep_buckets(self, now: float):
+        # Повний і не призупинений bucket нічого не пам'ятає - його можна викинути
+        for chat_id in [c for c, b in self._buckets.items()
+                        if c not in self._chats and b.delay(now) == 0 and b.tokens >= b.capacity]:
+            del self._buckets[chat_id]
+        self._next_sweep = now + 60
+
+    def stats(self) -> dict:
+        return {
+            "outbound_waiting_critical": self.waiting_by_priority[PRIORITY_CRITICAL],
+            "outbound_waiting_normal": self.waiting_by_priority[PRIORITY_NORMAL],
+            "outbound_waiting_low": self.waiting_by_priority[PRIORITY_LOW],
+            "outbound_throttled_total": self.throttled_total,
+            "outbound_retry_after_total": self.retry_after_total,
+            "outbound_errors_total": self.errors_total,
+        }
+
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сесії aiogram: кожен виклик API бота проходить через планувальник,
+    тож ліміти і retry_after обробляються в одному місці для всього коду.
+    """
+
+    def __init__(self, scheduler: OutboundScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method) # Long polling не обмежуємо
+
+        name = type(method).__name__
+        priority = _priority_override.get()
+        if priority is None:
+            priority = PRIORITY_CRITICAL if name in CRITICAL_METHODS else PRIORITY_NORMAL
+        chat_id = getattr(method, "chat_id", None)
+        # Критичні дії не чекають на ліміт чату (лише на його паузу після retry_after); решта - чекає
+        bucket_chat = None if priority == PRIORITY_CRITICAL else chat_id
+
+        for attempt in range(MAX_RETRIES + 1):
+            if bucket_chat is None and chat_id is not None:
+                wait = self.scheduler.pause_left(chat_id)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            await self.scheduler.acquire(priority, bucket_chat)
+            if metrics.ENABLED:
+                metrics.TG_CALLS.inc(name)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                # Флуд-ліміт: ставимо на паузу чат виклику (або все, якщо чату немає) і пробуємо знову
+                self.scheduler.pause(chat_id, e.retry_after)
+                if metrics.ENABLED:
+                    metrics.TG_ERRORS.inc(name)
+                if attempt == MAX_RETRIES:
+                    self.scheduler.errors_total += 1
+                    print(f"Telegram flood limit: {name} dropped after {MAX_RETRIES} retries")
+                    raise
+            except Exception:
+                if metrics.ENABLED:
+                    metrics.TG_ERRORS.inc(name)
+                raise
+
+
+scheduler = OutboundScheduler()
+
+def setup(bot):
+    """Підключає планувальник до сесії бота."""
+    bot.session.middleware(OutboundMiddleware(scheduler))
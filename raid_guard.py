@@ -0,0 +1,68 @@
+# raid_guard.py
+import time
+from collections import deque
+
+
+class ChatRaidState:
+    """Стан одного чату: недавні входи, чи йде рейд, і поточна партія новачків під спільною капчею."""
+    __slots__ = ("joins", "raid_until", "pending", "captcha_message_id", "batch_expires_at")
+
+    def __init__(self):
+        self.joins = deque()
+        self.raid_until = 0.0
+        self.pending = set()           # ID новачків, які ще не натиснули кнопку
+        self.captcha_message_id = None # Спільне повідомлення з капчею для всієї партії
+        self.batch_expires_at = 0.0
+
+
+class RaidGuard:
+    """
+    Детектор масових входів. Якщо за window секунд зайшло більше ніж limit людей,
+    чат переходить у режим рейду на duration секунд (і продовжується, поки входи тривають).
+    """
+
+    def __init__(self, duration: float = 600):
+        self.duration = duration
+        self._chats = {}
+
+    def state(self, chat_id: int) -> ChatRaidState:
+        st = self._chats.get(chat_id)
+        if st is None:
+            st = self._chats[chat_id] = ChatRaidState()
+        return st
+
+    def register_joins(self, chat_id: int, count: int, limit: int, window: float, now: float = None) -> bool:
+        """Рахує нові входи. Повертає True, якщо чат зараз у режимі рейду."""
+        if now is None:
+            now = time.monotonic()
+        st = self.state(chat_id)
+        joins = st.joins
+        for _ in range(count):
+            joins.append(now)
+        while joins and now - joins[0] >= window:
+            joins.popleft()
+
+        if len(joins) > limit:
+            st.raid_until = max(st.raid_until, now + self.duration)
+        return st.raid_until > now
+
+    def is_raid(self, chat_id: int, now: float = None) -> bool:
+        st = self._chats.get(chat_id)
+        return bool(st) and st.raid_until > (time.monotonic() if now is None else now)
+
+    def set_raid(self, chat_id: int, enabled: bool):
+        # Ручне вмикання/вимикання з адмінки
+        st = self.state(chat_id)
+        st.raid_until = time.monotonic() + self.duration if enabled else 0.0
+        if not enabled:
+            st.joins.clear()
+
+    def seconds_left(self, chat_id: int) -> int:
+        st = self._chats.get(chat_id)
+        return max(0, int(st.raid_until - time.monotonic())) if st else 0
+
+    def forget_idle(self, chat_id: int):
+        # Прибираємо стан чату, якщо там нічого не відбувається
+        st = self._chats.get(chat_id)
+        if st and not st.pending and not st.joins and not self.is_raid(chat_id):
+            del self._chats[chat_id]
@@ -0,0 +1,108 @@
+# Переповнений шард: що відкидається, що повертає SHARD_FULL (webhook -> 503), а що чекає місця.
+# Запуск: python -m pytest -q
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+import update_shards
+
+bot = Bot("123456:TEST-TOKEN")
+_next_id = iter(range(1, 1_000_000))
+
+
+def group_message(chat_id: int, **extra) -> Update:
+    update_id = next(_next_id)
+    return Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": "спам",
+            "chat": {"id": chat_id, "type": "supergroup", "title": "Test"},
+            "from": {"id": 7, "is_bot": False, "first_name": "User"},
+            **extra,
+        },
+    }, context={"bot": bot})
+
+
+def callback_click(chat_id: int) -> Update:
+    update_id = next(_next_id)
+    return Update.model_validate({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "chat_instance": "1", "data": "captcha:7",
+            "from": {"id": 7, "is_bot": False, "first_name": "User"},
+            "message": {"message_id": 1, "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "supergroup", "title": "Test"}},
+        },
+    }, context={"bot": bot})
+
+
+def pre_checkout(user_id: int) -> Update:
+    update_id = next(_next_id)
+    return Update.model_validate({
+        "update_id": update_id,
+        "pre_checkout_query": {
+            "id": str(update_id), "currency": "XTR", "total_amount": 50, "invoice_payload": "premium",
+            "from": {"id": user_id, "is_bot": False, "first_name": "Payer"},
+        },
+    }, context={"bot": bot})
+
+
+def make_dispatcher(block: bool, maxsize: int = 4):
+    # Один шард і без воркерів: черга лишається такою, якою ми її заповнили
+    sharded = update_shards.ShardedDispatch(workers=1, maxsize=maxsize, block=block)
+    dp = Dispatcher()
+    dp.update.outer_middleware(sharded)
+    return dp, sharded
+
+
+def test_full_shard_reports_full_for_non_message_updates():
+    async def run():
+        dp, sharded = make_dispatcher(block=False)
+        # Жоден чат не флудить: черга заповнена чотирма різними групами
+        for chat_id in (-1001, -1002, -1003, -1004):
+            assert await dp.feed_update(bot, group_message(chat_id)) is None
+        assert await dp.feed_update(bot, callback_click(-1001)) is update_shards.SHARD_FULL
+        assert await dp.feed_update(bot, pre_checkout(42)) is update_shards.SHARD_FULL
+        # Звичайне повідомлення чату, що не забив чергу, теж не відкидається
+        assert await dp.feed_update(bot, group_message(-1005)) is update_shards.SHARD_FULL
+        stats = sharded.stats()
+        assert stats["update_full_total"] == 3
+        assert stats["update_shed_total"] == 0
+        assert stats["update_queue_depth"] == 4
+    asyncio.run(run())
+
+
+def test_full_shard_sheds_only_flooding_group_messages():
+    async def run():
+        dp, sharded = make_dispatcher(block=False)
+        for _ in range(4):
+            await dp.feed_update(bot, group_message(-1001))
+        assert await dp.feed_update(bot, group_message(-1001)) is None
+        assert sharded.stats()["update_shed_total"] == 1
+        # Вхід у чат і кнопку того самого чату не відкидаємо
+        joined = group_message(-1001, new_chat_members=[{"id": 8, "is_bot": False, "first_name": "New"}])
+        assert await dp.feed_update(bot, joined) is update_shards.SHARD_FULL
+        assert await dp.feed_update(bot, callback_click(-1001)) is update_shards.SHARD_FULL
+        assert sharded.stats()["update_shed_total"] == 1
+    asyncio.run(run())
+
+
+def test_full_shard_blocks_until_space_in_polling_mode():
+    async def run():
+        dp, sharded = make_dispatcher(block=True, maxsize=1)
+        await dp.feed_update(bot, group_message(-1001))
+        waiting = asyncio.create_task(dp.feed_update(bot, pre_checkout(42)))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        sharded.start()
+        await asyncio.wait_for(waiting, 1)
+        await sharded.stop()
+        stats = sharded.stats()
+        assert stats["update_processed_total"] == 2
+        assert stats["update_full_total"] == 0
+    asyncio.run(run())
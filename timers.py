@@ -0,0 +1,139 @@
+# timers.py
+import asyncio
+import heapq
+import itertools
+import json
+import time
+import database as db
+
+
+class TimerScheduler:
+    """
+    Відкладені дії (протухла капча тощо) без окремої asyncio-задачі на кожного юзера:
+    одна купа в пам'яті + одна задача, яка спить до найближчого таймера.
+    Таймери зберігаються в БД, тож переживають перезапуск бота.
+    """
+
+    def __init__(self, max_concurrency: int = 20):
+        self._heap = []      # [(коли, seq, key)]
+        self._timers = {}    # {key: (коли, kind, payload)} - актуальні таймери (у купі можуть бути застарілі записи)
+        self._handlers = {}  # {kind: async fn(payload)}
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._running = set()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.fired_total = 0
+
+    def __len__(self):
+        return len(self._timers)
+
+    def handler(self, kind: str):
+        """Декоратор: @timer_scheduler.handler("captcha")"""
+        def decorator(fn):
+            self._handlers[kind] = fn
+            return fn
+        return decorator
+
+    def get(self, key: str):
+        """Payload таймера або None."""
+        timer = self._timers.get(key)
+        return timer[2] if timer else None
+
+    async def stored(self, key: str):
+        """(коли, payload) таймера з БД - актуальні й для таймерів інших копій бота; None, якщо немає."""
+        try:
+            row = await db.get_timer(key)
+        except Exception as e:
+            print(f"Не вдалося прочитати таймер {key}: {e}")
+            return None
+        return (row['due_at'], json.loads(row['payload'])) if row else None
+
+    def pending(self, kind: str):
+        """Усі актуальні таймери одного типу: [(key, коли, payload), ...]"""
+        return [(key, t[0], t[2]) for key, t in self._timers.items() if t[1] == kind]
+
+    async def schedule(self, key: str, delay: float, kind: str, payload: dict, due_at: float = None):
+        """Ставить (або переставляє) таймер. Той самий key замінює попередній."""
+        if due_at is None:
+            due_at = time.time() + delay
+        self._push(key, due_at, kind, payload)
+        try:
+            await db.save_timer(key, due_at, kind, json.dumps(payload))
+        except Exception as e:
+            print(f"Не вдалося зберегти таймер {key}: {e}")
+
+    async def cancel(self, key: str):
+        # Рядок у БД видаляємо завжди: таймер могла поставити інша копія бота
+        self._timers.pop(key, None)
+        try:
+            await db.delete_timer(key)
+        except Exception as e:
+            print(f"Не вдалося видалити таймер {key}: {e}")
+
+    async def load(self):
+        """При старті: піднімаємо всі таймери з БД (прострочені спрацюють одразу)."""
+        for row in await db.get_all_timers():
+            self._push(row['timer_key'], row['due_at'], row['kind'], json.loads(row['payload']))
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _push(self, key: str, due_at: float, kind: str, payload: dict):
+        self._timers[key] = (due_at, kind, payload)
+        heapq.heappush(self._heap, (due_at, next(self._seq), key))
+        if self._wakeup and self._heap[0][2] == key:
+            self._wakeup.set() # Новий таймер раніше за всі - будимо цикл
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                due_at, _, key = heapq.heappop(self._heap)
+                timer = self._timers.get(key)
+                if timer is None or timer[0] != due_at:
+                    continue # Скасований або переставлений таймер
+                del self._timers[key]
+                task = asyncio.create_task(self._fire(key, timer[1], timer[2]))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, key: str, kind: str, payload: dict):
+        async with self._semaphore:
+            try:
+                # Забираємо таймер з БД; якщо його вже забрала або відсунула інша копія бота - нічого не робимо
+                stored = await db.claim_timer(key, time.time())
+                if stored is None:
+                    return
+                payload = json.loads(stored) # Збережений payload свіжіший: його могла оновити інша копія
+            except Exception as e:
+                print(f"Не вдалося забрати таймер {key}: {e}")
+                return
+
+            handler = self._handlers.get(kind)
+            if handler is None:
+                print(f"Немає обробника для таймера {kind}")
+                return
+            try:
+                await handler(payload)
+                self.fired_total += 1
+            except Exception as e:
+                print(f"Помилка таймера {key}: {e}")
+
+
+scheduler = TimerScheduler()
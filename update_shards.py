@@ -0,0 +1,180 @@
+# update_shards.py
+import asyncio
+import os
+import time
+from aiogram import BaseMiddleware
+
+# Скільки воркерів обробляє апдейти і скільки апдейтів може чекати в черзі кожного
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 8))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 100))
+DRAIN_TIMEOUT = 5 # секунд на дообробку черг при зупинці
+# Якщо переповнений шард на стільки (частка черги) забитий одним чатом, звичайні повідомлення
+# цього чату відкидаються. Решта апдейтів (платежі, кнопки, входи в чат) не відкидаються ніколи
+FLOOD_SHARE = float(os.getenv("SHARD_FLOOD_SHARE", 0.5))
+LAG_WINDOW = 60 # секунд: max_lag - найбільше очікування за останні 1-2 такі вікна
+
+
+# Повертається з dp.feed_update, коли шард переповнений і апдейт не прийнято (лише якщо block=False)
+SHARD_FULL = "shard_full"
+
+
+class _Shard:
+    __slots__ = ("queue", "task", "chat_pending", "processed_total", "failed_total", "shed_total",
+                 "full_total", "last_lag", "max_lag", "prev_max_lag", "window_start")
+
+    def __init__(self, maxsize: int):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.task = None
+        self.chat_pending = {} # {key: скільки апдейтів цього чату чекає в черзі}
+        self.processed_total = 0
+        self.failed_total = 0
+        self.shed_total = 0 # Відкинуті звичайні повідомлення чату, що флудить
+        self.full_total = 0 # Апдейти, не прийняті через переповнення (block=False)
+        self.last_lag = 0.0 # Скільки останній апдейт чекав у черзі
+        self.max_lag = 0.0  # Найбільше очікування в поточному вікні
+        self.prev_max_lag = 0.0
+        self.window_start = time.monotonic()
+
+    def roll(self, now: float):
+        # Вікна рахуються за часом, а не за викликами stats(), тож /status і /metrics не заважають одне одному
+        elapsed = now - self.window_start
+        if elapsed >= LAG_WINDOW:
+            self.prev_max_lag = self.max_lag if elapsed < 2 * LAG_WINDOW else 0.0
+            self.max_lag = 0.0
+            self.window_start = now
+
+    def peak_lag(self, now: float) -> float:
+        self.roll(now)
+        return max(self.max_lag, self.prev_max_lag)
+
+
+class ShardedDispatch(BaseMiddleware):
+    """
+    Outer-middleware для dp.update: апдейт не обробляється одразу, а кладеться в чергу
+    шарда за chat_id. Один чат - завжди один воркер, тож порядок повідомлень у чаті
+    зберігається, а різні чати обробляються паралельно.
+    Черги обмежені. Коли шард переповнений:
+    - звичайне повідомлення групи, яка сама забила шард (FLOOD_SHARE), відкидається;
+    - решта апдейтів не губиться: з block=True (polling) put() чекає місця - це backpressure
+      на getUpdates; з block=False (webhook) повертається SHARD_FULL, і Telegram пришле апдейт повторно.
+    """
+
+    def __init__(self, workers: int = UPDATE_WORKERS, maxsize: int = UPDATE_QUEUE_SIZE, block: bool = True):
+        self.shards = [_Shard(maxsize) for _ in range(workers)]
+        self.block = block
+        self.on_first_update = None # Викликається один раз після першого обробленого апдейту
+
+    def start(self):
+        for shard in self.shards:
+            if shard.task is None:
+                shard.task = asyncio.create_task(self._worker(shard))
+
+    async def stop(self, timeout: float = DRAIN_TIMEOUT):
+        # Даємо воркерам дообробити те, що вже в чергах
+        try:
+            await asyncio.wait_for(asyncio.gather(*(s.queue.join() for s in self.shards)), timeout)
+        except asyncio.TimeoutError:
+            print(f"Не дочекались обробки {sum(s.queue.qsize() for s in self.shards)} апдейтів")
+        tasks = [s.task for s in self.shards if s.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for shard in self.shards:
+            shard.task = None
+
+    def shard_for(self, key: int) -> _Shard:
+        return self.shards[key % len(self.shards)]
+
+    async def __call__(self, handler, event, data):
+        # event_chat/event_from_user вже поставив UserContextMiddleware диспетчера
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        key = chat.id if chat else (user.id if user else 0)
+        shard = self.shard_for(key)
+        if shard.queue.full():
+            if self._is_flooding(shard, key, event, chat):
+                shard.shed_total += 1
+                return None
+            if not self.block:
+                shard.full_total += 1
+                return SHARD_FULL
+        shard.chat_pending[key] = shard.chat_pending.get(key, 0) + 1
+        try:
+            await shard.queue.put((time.monotonic(), key, handler, event, data))
+        except BaseException:
+            self._done(shard, key)
+            raise
+
+    @staticmethod
+    def _done(shard: _Shard, key: int):
+        left = shard.chat_pending.get(key, 1) - 1
+        if left:
+            shard.chat_pending[key] = left
+        else:
+            shard.chat_pending.pop(key, None)
+
+    @staticmethod
+    def _is_flooding(shard: _Shard, key: int, event, chat) -> bool:
+        # Відкидати можна лише звичайні повідомлення групи, яка займає більшу частину черги
+        message = getattr(event, "message", None)
+        if message is None or chat is None or chat.type not in ("group", "supergroup"):
+            return False
+        if message.new_chat_members or message.left_chat_member:
+            return False
+        return shard.chat_pending.get(key, 0) >= shard.queue.maxsize * FLOOD_SHARE
+
+    async def _worker(self, shard: _Shard):
+        while True:
+            enqueued_at, key, handler, event, data = await shard.queue.get()
+            self._done(shard, key)
+            now = time.monotonic()
+            lag = now - enqueued_at
+            shard.roll(now)
+            shard.last_lag = lag
+            if lag > shard.max_lag:
+                shard.max_lag = lag
+            try:
+                await handler(event, data)
+                shard.processed_total += 1
+            except Exception as e:
+                shard.failed_total += 1
+                print(f"Error update {getattr(event, 'update_id', '?')}: {e}")
+            finally:
+                shard.queue.task_done()
+            if self.on_first_update:
+                callback, self.on_first_update = self.on_first_update, None
+                callback()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "update_queue_depth": sum(s.queue.qsize() for s in self.shards),
+            "update_queue_capacity": sum(s.queue.maxsize for s in self.shards),
+            "update_max_lag_seconds": round(max(s.peak_lag(now) for s in self.shards), 3),
+            "update_processed_total": sum(s.processed_total for s in self.shards),
+            "update_failed_total": sum(s.failed_total for s in self.shards),
+            "update_shed_total": sum(s.shed_total for s in self.shards),
+            "update_full_total": sum(s.full_total for s in self.shards),
+        }
+
+    def shard_stats(self) -> list:
+        """По кожному шарду окремо (для /status)."""
+        now = time.monotonic()
+        return [{
+            "shard": n,
+            "depth": s.queue.qsize(),
+            "lag_seconds": round(s.last_lag, 3),
+            "max_lag_seconds": round(s.peak_lag(now), 3),
+            "processed_total": s.processed_total,
+            "failed_total": s.failed_total,
+            "shed_total": s.shed_total,
+            "full_total": s.full_total,
+        } for n, s in enumerate(self.shards)]
+
+    def labelled_gauges(self) -> list:
+        """Для metrics.register_labelled_gauges: ті самі значення з міткою shard."""
+        result = []
+        for row in self.shard_stats():
+            labels = {"shard": row.pop("shard")}
+            result.extend((f"update_shard_{name}", labels, value) for name, value in row.items())
+        return result
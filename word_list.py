@@ -1,36 +1,326 @@
 # word_list.py
+import os
+import sys
+from collections import OrderedDict
+
+class _WatchedSet(set):
+    """
+    Звичайний set, який рахує свої зміни (version).
+    Потрібен, щоб автомат перебудовувався сам, коли хтось редагує список.
+    """
+    __slots__ = ("version",)
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.version = 0
+
+    def add(self, item):
+        super().add(item); self.version += 1
+
+    def discard(self, item):
+        super().discard(item); self.version += 1
+
+    def remove(self, item):
+        super().remove(item); self.version += 1
+
+    def pop(self):
+        self.version += 1
+        return super().pop()
+
+    def clear(self):
+        super().clear(); self.version += 1
+
+    def update(self, *others):
+        super().update(*others); self.version += 1
+
+    def difference_update(self, *others):
+        super().difference_update(*others); self.version += 1
+
+    def intersection_update(self, *others):
+        super().intersection_update(*others); self.version += 1
+
+    def symmetric_difference_update(self, other):
+        super().symmetric_difference_update(other); self.version += 1
+
+    def __ior__(self, other):
+        super().__ior__(other); self.version += 1
+        return self
+
+    def __isub__(self, other):
+        super().__isub__(other); self.version += 1
+        return self
+
+    def __iand__(self, other):
+        super().__iand__(other); self.version += 1
+        return self
+
+    def __ixor__(self, other):
+        super().__ixor__(other); self.version += 1
+        return self
+
 
 # Список коренів для звичайних порушень (спам, реклама, шахрайство)
-BAD_WORDS_NORMAL = {
+BAD_WORDS_NORMAL = _WatchedSet({
     "заробіток", "крипта", "криптовалют", "біткоїн", "bitcoin",
     "інвестиції", "пасивний дохід", "розіграш", "giveaway",
     "підпишись", "взаємна підписка", "рефералка", "посилання в профілі",
     "казино", "ставки", "1xbet", "виграш", "акція"
-}
+})
 
 # Список коренів для тяжких порушень (мати, образи, агресія)
 # УВАГА: Це лише корені. Бот шукатиме входження цих частин у словах.
-BAD_WORDS_HEAVY = {
+BAD_WORDS_HEAVY = _WatchedSet({
     "хуй", "хує", "хуя", "пізд", "пизд", "єба", "еба", "блять", "бляд",
     "мудак", "гандон", "шлюх", "підар", "педик", "хохол",
     "нігер", "смерть", "убити", "різати", "суїцид", "нарко", "сіськи"
+})
+
+# Рівні порушень (більший рівень перемагає)
+LEVEL_NORMAL = 1
+LEVEL_HEAVY = 2
+LEVEL_NAMES = {LEVEL_NORMAL: "normal", LEVEL_HEAVY: "heavy"}
+
+
+# --- НОРМАЛІЗАЦІЯ ТЕКСТУ (анти-обхід фільтра) ---
+# Латинські двійники і цифри, якими підміняють кирилицю ("xуй", "п0рн0")
+_HOMOGLYPHS = {
+    "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "i": "і", "k": "к",
+    "m": "м", "o": "о", "p": "р", "t": "т", "x": "х", "y": "у", "ё": "е",
+    "0": "о", "1": "і", "3": "з", "4": "ч", "6": "б", "@": "а",
 }
+# Скільки різних символів максимум запам'ятовуємо в таблиці (захист від емодзі-спаму)
+_FOLD_TABLE_LIMIT = 20000
+
+def _fold_char(ch: str) -> str:
+    """Що лишається від символу після нормалізації ('' - символ викидається)."""
+    out = []
+    for c in ch.lower():
+        c = _HOMOGLYPHS.get(c, c)
+        # Пробіли, пунктуація, emoji і невидимі символи (zero-width, soft hyphen) не є буквами - викидаємо
+        if c.isalnum():
+            out.append(c)
+    return "".join(out)
+
+# Таблицю для ASCII, латиниці і кирилиці рахуємо заздалегідь, решта доповнюється по ходу
+_FOLD_TABLE = {chr(i): _fold_char(chr(i)) for i in range(0x500)}
+
+def normalize_text(text: str) -> tuple[str, list[int]]:
+    """
+    Нормалізує текст за один прохід: нижній регістр, двійники -> кирилиця, цифри -> букви,
+    без пробілів/пунктуації/невидимих символів, повтори букв стиснуті ("хуууй" -> "хуй").
+    Повертає (нормалізований текст, offsets), де offsets[i] - індекс символу в оригіналі.
+    """
+    table = _FOLD_TABLE
+    chars = []
+    offsets = []
+    last = ""
+    for i, ch in enumerate(text):
+        rep = table.get(ch)
+        if rep is None:
+            rep = _fold_char(ch)
+            if len(table) < _FOLD_TABLE_LIMIT: table[ch] = rep
+        for c in rep:
+            if c != last:
+                chars.append(c)
+                offsets.append(i)
+                last = c
+    return "".join(chars), offsets
+
+def prepare_root(root: str) -> str:
+    # Корені готуємо так само, як текст, інакше вони не збігатимуться
+    return normalize_text(root)[0]
 
-def check_text_violation(text: str) -> str | None:
+
+class RootMatcher:
+    """
+    Автомат Ахо-Корасік: знаходить усі корені (тяжкі і звичайні) за один прохід по тексту.
+    Будується один раз, далі перевірка коштує O(довжина тексту) незалежно від кількості коренів.
+    """
+    __slots__ = ("_goto", "_fail", "_level", "_out", "size_bytes")
+
+    def __init__(self, heavy, normal):
+        self._goto = [{}]   # переходи: стан -> {символ: стан}
+        self._fail = [0]    # fail-посилання
+        self._level = [0]   # найвищий рівень порушення, який закінчується в цьому стані
+        self._out = [()]    # усі корені, що закінчуються в цьому стані: (корінь, рівень)
+
+        roots = {}
+        for root in normal:
+            root = prepare_root(root)
+            if root: roots[root] = LEVEL_NORMAL
+        # Тяжкі додаємо після звичайних, щоб при дублікаті перемагав тяжкий рівень
+        for root in heavy:
+            root = prepare_root(root)
+            if root: roots[root] = LEVEL_HEAVY
+
+        for root, level in roots.items():
+            self._add(root, level)
+        self._build()
+        # Приблизний розмір автомата в пам'яті (для LRU-кешу чатів)
+        self.size_bytes = (sum(sys.getsizeof(d) for d in self._goto)
+                           + sys.getsizeof(self._goto) * 4
+                           + sum(sys.getsizeof(o) for o in self._out))
+
+    def _add(self, root: str, level: int):
+        state = 0
+        for ch in root:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._level.append(0)
+                self._out.append(())
+                self._goto[state][ch] = nxt
+            state = nxt
+        self._level[state] = max(self._level[state], level)
+        self._out[state] = ((root, level),)
+
+    def _build(self):
+        # BFS: рахуємо fail-посилання і зливаємо виходи з fail-ланцюжка
+        goto, fail, level, out = self._goto, self._fail, self._level, self._out
+        queue = list(goto[0].values())
+        i = 0
+        while i < len(queue):
+            state = queue[i]
+            i += 1
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(ch, 0)
+                fail[nxt] = f
+                level[nxt] = max(level[nxt], level[f])
+                if out[f]:
+                    out[nxt] = out[nxt] + out[f]
+
+    def check(self, text: str) -> str | None:
+        """Повертає 'heavy', 'normal' або None. Текст має бути вже підготовлений."""
+        goto, fail, level = self._goto, self._fail, self._level
+        state = 0
+        best = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            lvl = level[state]
+            if lvl == LEVEL_HEAVY:
+                return "heavy" # Тяжке знайдено - далі можна не дивитись
+            if lvl > best:
+                best = lvl
+        return LEVEL_NAMES.get(best)
+
+    def find_all(self, text: str) -> list[tuple[int, int, str, str]]:
+        """Усі входження коренів: [(start, end, корінь, 'heavy'/'normal'), ...]"""
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        found = []
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for root, lvl in out[state]:
+                found.append((i + 1 - len(root), i + 1, root, LEVEL_NAMES[lvl]))
+        return found
+
+
+# Кеш автомата для глобальних списків: (ключ версій, автомат)
+_matcher_cache = (None, None)
+
+def _global_key():
+    return (id(BAD_WORDS_HEAVY), getattr(BAD_WORDS_HEAVY, "version", None),
+            id(BAD_WORDS_NORMAL), getattr(BAD_WORDS_NORMAL, "version", None))
+
+def get_matcher() -> RootMatcher:
+    """Повертає автомат для BAD_WORDS_*; перебудовує його, лише якщо списки змінились."""
+    global _matcher_cache
+    key = _global_key()
+    cached_key, matcher = _matcher_cache
+    if matcher is None or cached_key != key or key[1] is None or key[3] is None:
+        # Якщо списки замінили на звичайні set - версії немає, тож перебудовуємо завжди
+        matcher = RootMatcher(BAD_WORDS_HEAVY, BAD_WORDS_NORMAL)
+        _matcher_cache = (key, matcher)
+    return matcher
+
+# --- СВОЇ СПИСКИ ДЛЯ КОЖНОГО ЧАТУ ---
+# Типи слів у таблиці chat_words
+WORD_KINDS = ("heavy", "normal", "exempt")
+
+# Списки чатів тримаємо в пам'яті повністю (це лише рядки): {chat_id: (heavy, normal, exempt)}
+CHAT_WORDS = {}
+
+# Скомпільовані автомати чатів: LRU з лімітом по пам'яті
+CHAT_MATCHER_CACHE_BYTES = int(os.getenv("CHAT_MATCHER_CACHE_MB", 32)) * 1024 * 1024
+_chat_matchers = OrderedDict() # {chat_id: (ключ глобальних списків, автомат)}
+_chat_matchers_bytes = 0
+
+def _drop_chat_matcher(chat_id: int):
+    global _chat_matchers_bytes
+    entry = _chat_matchers.pop(chat_id, None)
+    if entry:
+        _chat_matchers_bytes -= entry[1].size_bytes
+
+def set_chat_words(chat_id: int, heavy=(), normal=(), exempt=()):
+    """Замінює список чату і скидає його автомат (перебудується при наступному повідомленні)."""
+    if heavy or normal or exempt:
+        CHAT_WORDS[chat_id] = (frozenset(heavy), frozenset(normal), frozenset(exempt))
+    else:
+        CHAT_WORDS.pop(chat_id, None)
+    _drop_chat_matcher(chat_id)
+
+def load_chat_words(rows):
+    """Завантажує всі списки з БД одним махом: rows = [(chat_id, root, kind), ...]"""
+    grouped = {}
+    for chat_id, root, kind in rows:
+        lists = grouped.setdefault(chat_id, {k: [] for k in WORD_KINDS})
+        if kind in lists:
+            lists[kind].append(root)
+    for chat_id, lists in grouped.items():
+        set_chat_words(chat_id, lists["heavy"], lists["normal"], lists["exempt"])
+
+def get_chat_matcher(chat_id: int | None) -> RootMatcher:
+    """Автомат для конкретного чату (глобальні корені + свої - винятки)."""
+    global _chat_matchers_bytes
+    words = CHAT_WORDS.get(chat_id) if chat_id is not None else None
+    if not words:
+        return get_matcher()
+
+    key = _global_key()
+    entry = _chat_matchers.get(chat_id)
+    if entry and entry[0] == key and key[1] is not None and key[3] is not None:
+        _chat_matchers.move_to_end(chat_id)
+        return entry[1]
+
+    heavy, normal, exempt = words
+    exempt = {prepare_root(r) for r in exempt}
+    matcher = RootMatcher(
+        [r for r in (*BAD_WORDS_HEAVY, *heavy) if prepare_root(r) not in exempt],
+        [r for r in (*BAD_WORDS_NORMAL, *normal) if prepare_root(r) not in exempt],
+    )
+    _drop_chat_matcher(chat_id)
+    _chat_matchers[chat_id] = (key, matcher)
+    _chat_matchers_bytes += matcher.size_bytes
+
+    # Викидаємо найстаріші автомати, поки не влізем у ліміт (поточний лишаємо завжди)
+    while _chat_matchers_bytes > CHAT_MATCHER_CACHE_BYTES and len(_chat_matchers) > 1:
+        old_id = next(iter(_chat_matchers))
+        _drop_chat_matcher(old_id)
+    return matcher
+
+def check_text_violation(text: str, chat_id: int = None) -> str | None:
     """
-    Перевіряє текст на наявність заборонених коренів.
+    Перевіряє текст на наявність заборонених коренів (з урахуванням списку чату).
     Повертає 'heavy', 'normal' або None.
     """
-    text = text.lower().replace(" ", "") # Прибираємо пробіли для пошуку прихованих матів
-    
-    # Перевірка тяжких
-    for root in BAD_WORDS_HEAVY:
-        if root in text:
-            return "heavy"
-            
-    # Перевірка звичайних
-    for root in BAD_WORDS_NORMAL:
-        if root in text:
-            return "normal"
-            
-    return None
\ No newline at end of file
+    text, _ = normalize_text(text) # Прибираємо пробіли, двійники і т.д. для пошуку прихованих матів
+    return get_chat_matcher(chat_id).check(text)
+
+def find_text_violations(text: str, chat_id: int = None) -> list[tuple[int, int, str, str]]:
+    """
+    Усі знайдені корені з позиціями в ОРИГІНАЛЬНОМУ тексті:
+    [(start, end, корінь, 'heavy'/'normal'), ...], тобто text[start:end] - саме порушення.
+    """
+    normalized, offsets = normalize_text(text)
+    return [(offsets[start], offsets[end - 1] + 1, root, level)
+            for start, end, root, level in get_chat_matcher(chat_id).find_all(normalized)]